@@ -0,0 +1,237 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+# ITU-R 601 luma weights, as used by mx.image.ColorJitterAug
+_GRAY_COEF = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+# JPEG quality range of compress_aug
+_QUALITY_LOW, _QUALITY_HIGH = 2, 21
+
+
+class ProcessThreadPool(object):
+    """ThreadPoolExecutor of the current process.
+
+    Threads do not survive a fork, so a forked data worker gets its own
+    pool the first time it calls get().
+    """
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+        self.pool = None
+        self.pid = None
+
+    def get(self):
+        if self.pool is None or self.pid != os.getpid():
+            self.pool = ThreadPoolExecutor(self.num_threads)
+            self.pid = os.getpid()
+        return self.pool
+
+
+class EncodedCache(object):
+    """Thread-safe LRU of encoded images, bounded by entry count."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            buf = self.items.get(key)
+            if buf is None:
+                self.misses += 1
+            else:
+                self.items.move_to_end(key)
+                self.hits += 1
+            return buf
+
+    def put(self, key, buf):
+        with self.lock:
+            self.items[key] = buf
+            self.items.move_to_end(key)
+            while len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+
+class BatchAugmenter(object):
+    """Training augmentations applied to a whole decoded batch at once.
+
+    Works on an RGB uint8 (N,H,W,3) batch and its float32 (N,1,H,W)
+    occlusion masks. Every random parameter is drawn per sample, but each op
+    is a handful of vectorized NumPy calls over the batch instead of one
+    engine call per image. The random mirror is shared by an image and its
+    mask. An optional `occlusion` stage (see occlusion_aug) paints
+    synthetic occluders onto the faces and their masks after the mirror.
+
+    The JPEG round trips of compress_aug run on `compress_threads` threads;
+    OpenCV's codec releases the GIL. With `compress_cache` > 0 every record
+    gets `compress_variants` low-quality versions of fixed quality, encoded
+    once and kept in an LRU of that many entries. They are made from the
+    decoded record, so compression then comes before mirror and occlusion.
+    """
+    def __init__(self,
+                 rand_mirror=False,
+                 color_jittering=0,
+                 mean=None,
+                 cutoff=0,
+                 jitter=0.125,
+                 occlusion=None,
+                 compress_threads=4,
+                 compress_cache=0,
+                 compress_variants=2):
+        self.rand_mirror = rand_mirror
+        self.occlusion = occlusion
+        self.compress_threads = compress_threads
+        self.compress_variants = compress_variants
+        self.cache = None
+        if compress_cache > 0:
+            self.cache = EncodedCache(compress_cache)
+        self.pool = ProcessThreadPool(compress_threads)
+        self.color_jittering = color_jittering
+        self.mean = None
+        if mean is not None:
+            self.mean = np.array(mean, dtype=np.float32).reshape(1, 1, 1, 3)
+        self.cutoff = cutoff
+        self.jitter = jitter
+
+    def __call__(self, imgs, masks, rng, out=None, keys=None):
+        """Augments `imgs`/`masks` and writes the float32 NCHW data into
+        `out` (allocated when None). `masks` is updated in place. `keys`
+        are the record keys of the batch, needed by the compression cache.
+
+        Returns (data, masks).
+        """
+        data = self.augment(imgs, masks, rng, keys=keys)
+        return self.assemble(data, out), masks
+
+    def augment(self, imgs, masks, rng, keys=None):
+        """The augmentation part of __call__, in NHWC layout. Returns
+        `imgs` itself when no stage needs float pixels, so that the float
+        conversion is left to assemble()."""
+        cached = self.cache is not None and keys is not None
+        if self.color_jittering > 1 and cached:
+            self.compress_aug(imgs, rng, keys)
+        if self.rand_mirror:
+            self.mirror_aug(imgs, masks, rng)
+        if self.occlusion is not None:
+            self.occlusion(imgs, masks, rng)
+        if self.color_jittering > 1 and not cached:
+            self.compress_aug(imgs, rng)
+        if (self.color_jittering == 0 and self.mean is None
+                and self.cutoff == 0):
+            return imgs
+        data = imgs.astype(np.float32)
+        if self.color_jittering > 0:
+            self.color_aug(data, rng)
+        if self.mean is not None:
+            data -= self.mean
+            data *= 0.0078125
+        if self.cutoff > 0:
+            self.cutoff_aug(data, rng)
+        return data
+
+    def assemble(self, data, out=None):
+        """Copies NHWC `data` into the float32 NCHW batch `out`."""
+        n, h, w, c = data.shape
+        if out is None:
+            out = np.empty((n, c, h, w), dtype=np.float32)
+        out[:] = data.transpose(0, 3, 1, 2)
+        return out
+
+    def mirror_aug(self, imgs, masks, rng):
+        flip = rng.randint(0, 2, size=imgs.shape[0]).astype(bool)
+        if flip.any():
+            imgs[flip] = imgs[flip][:, :, ::-1, :]
+            masks[flip] = masks[flip][:, :, :, ::-1]
+
+    def compress_aug(self, imgs, rng, keys=None):
+        """JPEG round trip at a random quality in [2, 20] for half of the
+        batch on average; with `keys`, one of the record's cached variants
+        is used instead."""
+        n = imgs.shape[0]
+        do = rng.randint(0, 2, size=n).astype(bool)
+        quality = rng.randint(_QUALITY_LOW, _QUALITY_HIGH, size=n)
+        variant = None
+        if keys is not None:
+            variant = rng.randint(0, self.compress_variants, size=n)
+        todo = np.flatnonzero(do).tolist()
+        if len(todo) == 0:
+            return
+        if keys is None:
+            jobs = [(i, int(quality[i]), None) for i in todo]
+        else:
+            jobs = [(i, None, (int(keys[i]), int(variant[i]))) for i in todo]
+        if self.compress_threads > 1 and len(jobs) > 1:
+            list(self.pool.get().map(lambda job: self.compress_one(
+                imgs, *job), jobs))
+        else:
+            for job in jobs:
+                self.compress_one(imgs, *job)
+
+    def compress_one(self, imgs, i, quality, cache_key):
+        buf = None
+        if cache_key is not None:
+            buf = self.cache.get(cache_key)
+            if buf is None:
+                # fixed quality per (record, variant), the same in every
+                # worker and every run
+                key, v = cache_key
+                quality = _QUALITY_LOW + (key * 7919 + v * 104729) % (
+                    _QUALITY_HIGH - _QUALITY_LOW)
+        if buf is None:
+            _, buf = cv2.imencode('.jpg', imgs[i, :, :, ::-1],
+                                  [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+            if cache_key is not None:
+                self.cache.put(cache_key, buf)
+        imgs[i] = cv2.imdecode(buf, cv2.IMREAD_COLOR)[:, :, ::-1]
+
+    def color_aug(self, data, rng):
+        """Brightness, contrast and saturation jitter in a random order per
+        sample, equivalent to mx.image.ColorJitterAug(x, x, x)."""
+        n = data.shape[0]
+        x = self.jitter
+        alpha = 1.0 + rng.uniform(-x, x, size=(3, n)).astype(np.float32)
+        # per-sample random permutation of the three ops
+        order = np.argsort(rng.uniform(size=(n, 3)), axis=1)
+        for step in range(3):
+            for op in range(3):
+                sel = np.flatnonzero(order[:, step] == op)
+                if len(sel) == 0:
+                    continue
+                a = alpha[op, sel].reshape(-1, 1, 1, 1)
+                src = data[sel]
+                if op == 0:  # brightness
+                    src *= a
+                elif op == 1:  # contrast
+                    gray = np.dot(src, _GRAY_COEF).mean(axis=(1, 2))
+                    src *= a
+                    src += (1.0 - a) * gray.reshape(-1, 1, 1, 1)
+                else:  # saturation
+                    gray = np.dot(src, _GRAY_COEF)[:, :, :, np.newaxis]
+                    src *= a
+                    src += (1.0 - a) * gray
+                data[sel] = src
+
+    def cutoff_aug(self, data, rng):
+        """Fills a cutoff x cutoff square at a random center with 128 for
+        half of the batch on average."""
+        n, h, w = data.shape[:3]
+        do = rng.randint(0, 2, size=n).astype(bool)
+        half = self.cutoff // 2
+        centerh = rng.randint(0, h, size=n)
+        centerw = rng.randint(0, w, size=n)
+        rows = np.arange(h)
+        cols = np.arange(w)
+        inh = (rows >= (centerh - half)[:, None]) & (rows <
+                                                     (centerh + half)[:, None])
+        inw = (cols >= (centerw - half)[:, None]) & (cols <
+                                                     (centerw + half)[:, None])
+        region = inh[:, :, None] & inw[:, None, :] & do[:, None, None]
+        data[region] = 128
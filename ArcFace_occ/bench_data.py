@@ -0,0 +1,156 @@
+"""Standalone throughput benchmark of the training data pipeline.
+
+Runs FaceImageIter without a model, over a rec file or a synthetic one,
+and reports images/sec for every worker count. Per-stage latency
+percentiles (read, unpack, decode, mask, aug, assembly) are measured
+in-process, so they are only reported for --workers 0; assembly is the
+float conversion and NCHW copy into the host batch. `wait` is the time
+spent waiting for the consumer to release a host batch, not pipeline
+work.
+
+Usage: python bench_data.py --rec /path/to/train.rec --workers 0,2,4,8
+       python bench_data.py --synthetic 20000 --workers 0,4 --color 2
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import cv2
+
+from image_iter import FaceImageIter, FacePrefetchIter
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
+from rec_builder import RecBuilder
+
+STAGES = ['read', 'unpack', 'decode', 'mask', 'aug', 'assembly', 'wait']
+
+
+def make_synthetic(path, num_images, num_identities, image_size, seed=0):
+    """Writes a rec of smooth random faces with band-shaped occlusion masks
+    in the train.mask sidecar."""
+    rng = np.random.RandomState(seed)
+    h, w = image_size
+    builder = RecBuilder(path, image_size=image_size)
+    per_id = max(num_images // num_identities, 1)
+    for label in range(num_identities):
+        imgs = []
+        masks = []
+        for _ in range(per_id):
+            small = rng.randint(0, 256, size=(h // 8, w // 8, 3))
+            img = cv2.resize(small.astype(np.uint8), (w, h),
+                             interpolation=cv2.INTER_CUBIC)
+            mask = np.zeros((h, w), dtype=np.float32)
+            y = rng.randint(0, h // 2)
+            mask[y:y + h // 4] = 1.0
+            imgs.append(img)
+            masks.append(mask)
+        builder.add(label, imgs, masks)
+    builder.close()
+    return os.path.join(path, 'train.rec')
+
+
+def run(args, path_imgrec, num_workers, image_size):
+    data_shape = (3, image_size[0], image_size[1])
+    data_iter = FaceImageIter(
+        batch_size=args.batch_size,
+        data_shape=data_shape,
+        path_imgrec=path_imgrec,
+        shuffle=True,
+        rand_mirror=True,
+        cutoff=args.cutoff,
+        color_jittering=args.color,
+        data_workers=num_workers,
+        data_memmap=args.memmap,
+        shuffle_mode=args.shuffle_mode,
+        seed=0,
+        batch_buffers=max(4, args.prefetch + 3),
+        occluder_dir=args.occluders,
+        compress_threads=args.compress_threads,
+    )
+    data_iter.timer.enabled = num_workers == 0
+    source = data_iter
+    if args.prefetch > 0:
+        source = FacePrefetchIter(data_iter, depth=args.prefetch)
+
+    def next_batch():
+        try:
+            return source.next()
+        except StopIteration:
+            source.reset()
+            return source.next()
+
+    for _ in range(args.warmup):
+        next_batch()
+    data_iter.timer.reset()
+    tic = time.time()
+    for _ in range(args.batches):
+        next_batch()
+    elapsed = time.time() - tic
+    times = data_iter.timer.times
+    if args.prefetch > 0:
+        source.stop()
+    if data_iter.workers is not None:
+        data_iter.workers.close()
+    return args.batches * args.batch_size / elapsed, times
+
+
+def main(args):
+    image_size = [int(x) for x in args.image_size.split(',')]
+    tmp_dir = None
+    path_imgrec = args.rec
+    if not path_imgrec:
+        tmp_dir = tempfile.mkdtemp(prefix='bench_data_')
+        print('writing %d synthetic images to %s' % (args.synthetic, tmp_dir))
+        path_imgrec = make_synthetic(
+            tmp_dir, args.synthetic,
+            args.identities or max(args.synthetic // 20, 1), image_size)
+    try:
+        results = []
+        for num_workers in [int(x) for x in args.workers.split(',')]:
+            speed, times = run(args, path_imgrec, num_workers, image_size)
+            results.append((num_workers, speed))
+            print('workers %d: %.1f images/sec' % (num_workers, speed))
+            if not times:
+                continue
+            total = sum(sum(v) for v in times.values())
+            print('  %-9s %9s %9s %9s %7s' % ('stage', 'p50 ms', 'p90 ms',
+                                               'p99 ms', 'share'))
+            for stage in STAGES:
+                if stage not in times:
+                    continue
+                t = np.array(times[stage]) * 1000.0
+                p50, p90, p99 = np.percentile(t, [50, 90, 99])
+                print('  %-9s %9.2f %9.2f %9.2f %6.1f%%' %
+                      (stage, p50, p90, p99, 100.0 * t.sum() / 1000.0 / total))
+        print('summary (workers, images/sec):', results)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the training data pipeline')
+    # general
+    parser.add_argument('--rec', default='', type=str, help='path to train.rec, synthetic data when empty')
+    parser.add_argument('--synthetic', default=10000, type=int, help='synthetic images')
+    parser.add_argument('--identities', default=0, type=int, help='synthetic identities, default images/20')
+    parser.add_argument('--image-size', default='112,112', type=str, help='')
+    parser.add_argument('--batch-size', default=128, type=int, help='')
+    parser.add_argument('--batches', default=50, type=int, help='timed batches per run')
+    parser.add_argument('--warmup', default=5, type=int, help='untimed batches per run')
+    parser.add_argument('--workers', default='0,2,4', type=str, help='data_workers values to compare')
+    parser.add_argument('--prefetch', default=0, type=int, help='FacePrefetchIter depth, 0 to read inline')
+    parser.add_argument('--memmap', action='store_true', help='read the pre-decoded memmap store')
+    parser.add_argument('--shuffle-mode', default='full', type=str, help='')
+    parser.add_argument('--color', default=0, type=int, help='data_color')
+    parser.add_argument('--cutoff', default=0, type=int, help='data_cutoff')
+    parser.add_argument('--occluders', default='', type=str, help='occluder dir for synthetic occlusion')
+    parser.add_argument('--compress-threads', default=4, type=int, help='')
+    args = parser.parse_args()
+    main(args)
@@ -24,7 +24,28 @@ config.max_steps = 0
 config.data_rand_mirror = True
 config.data_cutoff = False
 config.data_color = 0
+config.data_compress_threads = 4  # data_color > 1: parallel JPEG round trips
+config.data_compress_cache = 0  # >0: cache this many low-quality record variants
 config.data_images_filter = 0
+config.data_workers = 0  # >0: decode and augment batches in this many processes
+config.data_memmap = False  # read pre-decoded images, see common/memmap_store.py
+config.data_shuffle = 'full'  # 'block': shuffle contiguous blocks, then within a buffer; 'occlusion' / 'identity': see data_occ_* / data_identity_*
+config.data_occ_thresholds = [0.05]  # occlusion ratio bucket edges, see common/occ_ratio.py
+config.data_occ_proportions = [0.5, 0.5]  # share of every bucket in a batch
+config.data_identity_images = 4  # data_shuffle 'identity': K images of each of batch/K identities
+config.data_identity_weights = 'uniform'  # identity draw weights: 'uniform', 'sqrt' or 'frequency'
+config.data_shuffle_block = 256
+config.data_shuffle_buffer = 8192
+config.data_seed = None  # None: pick one at random, it is saved in the .state files
+config.data_batch_buffers = 4  # reused host batches, at least data_prefetch + 3
+config.data_prefetch = 4  # batches queued ahead of the trainer, 0 reads inline
+config.data_occluders = ''  # dir of RGBA occluder PNGs composited at load time
+config.data_occlusion_prob = 0.5
+config.data_imglist = ''  # image folder or .lst file to train on instead of train.rec
+config.data_read_threads = 8  # file reads per batch in parallel, for data_imglist
+config.data_shards = ''  # tar shard dir to stream from, see common/rec2shards.py
+config.data_shard_readers = 4  # shards read in parallel
+config.data_sources = []  # [(dataset, weight), ...]: mix these datasets in every batch
 config.count_flops = True
 config.memonger = False  #not work now
 
@@ -10,6 +10,11 @@ import numbers
 import math
 import sklearn
 import datetime
+import time
+import queue
+import threading
+import traceback
+import multiprocessing
 import numpy as np
 import cv2
 
@@ -18,9 +23,29 @@ from mxnet import ndarray as nd
 from mxnet import io
 from mxnet import recordio
 
+from batch_aug import BatchAugmenter, ProcessThreadPool
+from occlusion_aug import OcclusionAugmenter
+import sampler
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
+from mask_pack import MaskReader, mask_path
+from rec_index import get_index
+from memmap_store import MemmapStore, has_store
+from mmap_recordio import MmapIndexedRecordIO
+from occ_ratio import load_ratios
+import image_codec
+
 logger = logging.getLogger()
 
 
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp')
+# occlusion mask of a.jpg is a_mask.png, nonzero where occluded
+MASK_SUFFIX = '_mask.png'
+
+
+def image_mask_path(path):
+    return os.path.splitext(path)[0] + MASK_SUFFIX
+
+
 class FaceImageIter(io.DataIter):
     def __init__(self,
                  batch_size,
@@ -33,45 +58,89 @@ class FaceImageIter(io.DataIter):
                  cutoff=0,
                  color_jittering=0,
                  images_filter=0,
+                 path_imglist=None,
+                 path_root=None,
+                 read_threads=8,
                  data_name='data',
                  label_name='softmax_label',
+                 data_workers=0,
+                 data_memmap=False,
+                 shuffle_mode='full',
+                 shuffle_block=256,
+                 shuffle_buffer=8192,
+                 seed=None,
+                 batch_buffers=4,
+                 num_parts=1,
+                 part_index=0,
+                 occluder_dir=None,
+                 occlusion_prob=0.5,
+                 occ_thresholds=(0.05, ),
+                 occ_proportions=(0.5, 0.5),
+                 identity_images=4,
+                 identity_weights='uniform',
+                 compress_threads=4,
+                 compress_cache=0,
                  **kwargs):
         super(FaceImageIter, self).__init__()
-        assert path_imgrec
+        assert path_imgrec or path_imglist
+        self.imgrec = None
+        self.read_threads = read_threads
+        self.pool = ProcessThreadPool(read_threads)
         if path_imgrec:
             logging.info('loading recordio %s...', path_imgrec)
             path_imgidx = path_imgrec[0:-4] + ".idx"
-            self.imgrec = recordio.MXIndexedRecordIO(path_imgidx, path_imgrec,
-                                                     'r')  # pylint: disable=redefined-variable-type
+            self.path_imgrec = path_imgrec
+            self.path_imgidx = path_imgidx
+            # mmap-backed: shared safely by threads and forked workers
+            self.imgrec = MmapIndexedRecordIO(path_imgidx, path_imgrec)
             s = self.imgrec.read_idx(0)
             header, _ = recordio.unpack(s)
             if header.flag > 0:
                 print('header0 label', header.label)
-                self.header0 = (int(header.label[0]), int(header.label[1]))
                 #assert(header.flag==1)
                 #self.imgidx = range(1, int(header.label[0]))
-                self.imgidx = []
+                # identity ranges are cached next to the rec, see rec_index
+                self.header0, identities, self.imgidx = get_index(
+                    self.imgrec, path_imgrec, images_filter)
                 self.id2range = {}
-                self.seq_identity = range(int(header.label[0]),
-                                          int(header.label[1]))
-                for identity in self.seq_identity:
-                    s = self.imgrec.read_idx(identity)
-                    header, _ = recordio.unpack(s)
-                    a, b = int(header.label[0]), int(header.label[1])
-                    count = b - a
-                    if count < images_filter:
-                        continue
+                self.seq_identity = range(self.header0[0], self.header0[1])
+                for identity, a, b in identities.tolist():
                     self.id2range[identity] = (a, b)
-                    self.imgidx += range(a, b)
                 print('id2range', len(self.id2range))
+                # positions of the identities in imgidx, for sharding
+                self.unit_bounds = np.r_[0, np.cumsum(identities[:, 2] -
+                                                      identities[:, 1])]
             else:
-                self.imgidx = list(self.imgrec.keys)
+                self.imgidx = np.array(self.imgrec.keys, dtype=np.int64)
+                self.unit_bounds = np.r_[np.arange(0, len(self.imgidx),
+                                                   shuffle_block),
+                                         len(self.imgidx)]
+            self.maskrec = None
+            if os.path.exists(mask_path(path_imgrec)):
+                logging.info('loading mask sidecar %s',
+                             mask_path(path_imgrec))
+                self.maskrec = MaskReader(mask_path(path_imgrec))
+            self.memmap = None
+            if data_memmap:
+                # pre-decoded images, built with common/memmap_store.py
+                if not has_store(path_imgrec):
+                    raise ValueError(
+                        'no memmap store for %s, run common/memmap_store.py'
+                        % path_imgrec)
+                logging.info('using pre-decoded memmap store')
+                self.memmap = MemmapStore(path_imgrec)
+            # batches are always assembled from explicit record indices so
+            # that worker processes can be handed a batch worth of keys
+            self.seq = self.imgidx
             if shuffle:
-                self.seq = self.imgidx
                 self.oseq = self.imgidx
                 print(len(self.seq))
-            else:
-                self.seq = None
+        else:
+            # image files read directly, see load_imglist
+            self.load_imglist(path_imglist, path_root, images_filter)
+            self.maskrec = None
+            self.memmap = None
+            self.seq = self.imgidx
 
         self.mean = mean
         self.nd_mean = None
@@ -84,30 +153,230 @@ class FaceImageIter(io.DataIter):
         self.batch_size = batch_size
         self.data_shape = data_shape
         self.shuffle = shuffle
+        assert shuffle_mode in ('full', 'block', 'occlusion', 'identity')
+        self.shuffle_mode = shuffle_mode
+        if shuffle_mode == 'identity':
+            assert hasattr(self, 'id2range'), 'identity sampling needs identities'
+            assert batch_size % identity_images == 0
+            self.identity_images = identity_images
+            self.identity_weights = identity_weights
+        if shuffle_mode == 'occlusion':
+            # per-key occlusion ratios, built with common/occ_ratio.py
+            assert path_imgrec, 'occlusion sampling needs a rec'
+            assert len(occ_proportions) == len(occ_thresholds) + 1
+            self.occ_ratio = load_ratios(path_imgrec)
+            self.occ_thresholds = list(occ_thresholds)
+            self.occ_proportions = list(occ_proportions)
+        self.shuffle_block = shuffle_block
+        self.shuffle_buffer = shuffle_buffer
         self.image_size = '%d,%d' % (data_shape[1], data_shape[2])
         self.rand_mirror = rand_mirror
         print('rand_mirror', rand_mirror)
         self.cutoff = cutoff
         self.color_jittering = color_jittering
-        self.CJA = mx.image.ColorJitterAug(0.125, 0.125, 0.125)
+        occlusion = None
+        if occluder_dir:
+            # synthetic occluders composited at load time, masks included
+            occlusion = OcclusionAugmenter(occluder_dir,
+                                           image_size=data_shape[1:],
+                                           prob=occlusion_prob)
+        self.augmenter = BatchAugmenter(rand_mirror=rand_mirror,
+                                        color_jittering=color_jittering,
+                                        mean=mean,
+                                        cutoff=cutoff,
+                                        occlusion=occlusion,
+                                        compress_threads=compress_threads,
+                                        compress_cache=compress_cache)
         self.provide_label = [('softmax_label', (batch_size, )),('mask_label', (batch_size, ))]
         #print(self.provide_label[0][1])
         self.cur = 0
         self.nbatch = 0
         self.is_init = False
+        # the epoch order and all augmentation draws are functions of
+        # (seed, epoch, batch), see get_state/set_state
+        assert 0 <= part_index < num_parts
+        self.num_parts = num_parts
+        self.part_index = part_index
+        if seed is None:
+            # shards are only disjoint when every worker uses the same seed
+            seed = 0 if num_parts > 1 else random.randint(0, 2**31 - 1)
+        self.seed = seed
+        print('data seed', seed)
+        self.epoch = -1
+        self.epoch_batches = 0
+        # batches of the epoch already used when set_state resumed it
+        self.resume_batches = 0
+        self.decode_buffer = None
+        # per-stage wall times, enabled by bench_data.py
+        self.timer = StageTimer()
+        self.buffers = None
+        self.workers = None
+        if data_workers > 0:
+            self.workers = FaceBatchWorkers(self, data_workers,
+                                            batch_buffers=batch_buffers)
+        else:
+            self.buffers = BatchBufferRing(batch_size, data_shape,
+                                           batch_buffers)
 
     def reset(self):
         """Resets the iterator to the beginning of the data."""
         print('call reset()')
+        if self.workers is not None:
+            self.workers.drain()
+        self.epoch += 1
         self.cur = 0
-        if self.shuffle:
-            random.shuffle(self.seq)
-        if self.seq is None and self.imgrec is not None:
-            self.imgrec.reset()
+        self.epoch_batches = 0
+        self.resume_batches = 0
+        self.build_seq()
+
+    def build_seq(self):
+        """Builds the sample order of the current epoch.
+
+        With num_parts > 1 only this worker's share of the identities (or of
+        record blocks for recs without identity records) is used; the split
+        changes every epoch but is the same on all workers.
+        """
+        rng = np.random.RandomState([self.seed, self.epoch])
+        if self.shuffle and self.shuffle_mode == 'identity':
+            self.seq = self.identity_seq(rng)
+            return
+        imgidx = self.imgidx
+        if self.num_parts > 1:
+            imgidx = sampler.partition(imgidx, self.unit_bounds,
+                                       self.num_parts, self.part_index, rng)
+        if not self.shuffle:
+            self.seq = imgidx
+        elif self.shuffle_mode == 'block':
+            # contiguous blocks in random order, shuffled within a
+            # bounded window: mostly sequential reads
+            self.seq = sampler.block_shuffle(imgidx, self.shuffle_block,
+                                             self.shuffle_buffer, rng)
+        elif self.shuffle_mode == 'occlusion':
+            # every batch mixes the occlusion ratio buckets in fixed shares
+            buckets = np.digitize(self.occ_ratio[imgidx], self.occ_thresholds)
+            self.seq = sampler.bucket_shuffle(imgidx, buckets,
+                                              self.batch_size,
+                                              self.occ_proportions, rng)
+        else:
+            self.seq = sampler.full_shuffle(imgidx, rng)
+
+    def identity_seq(self, rng):
+        """P identities x K images per batch, drawn with alias tables from
+        the identities of this worker's shard, see sampler.identity_sample.
+        An epoch has as many batches as a flat pass over the shard."""
+        bounds = np.asarray(self.unit_bounds, dtype=np.int64)
+        units = np.arange(len(bounds) - 1)
+        if self.num_parts > 1:
+            units = rng.permutation(len(units))[self.part_index::self.num_parts]
+        starts = bounds[units]
+        counts = bounds[units + 1] - starts
+        num_batches = len(self.imgidx) // self.num_parts // self.batch_size
+        weights = sampler.identity_weights(counts, self.identity_weights)
+        return sampler.identity_sample(self.imgidx, starts, counts,
+                                       num_batches,
+                                       self.batch_size // self.identity_images,
+                                       self.identity_images, weights, rng)
+
+    def get_state(self, num_batches=None):
+        """Returns the position of the iterator as a JSON-able dict.
+
+        `num_batches` is the number of batches the consumer has actually
+        used since the start of the epoch or, in the epoch resumed by
+        set_state, since the resume, like Module.fit's nbatch. By default
+        it is the batches returned so far, which is ahead of the trainer
+        when a prefetcher sits in between.
+        """
+        if num_batches is None:
+            num_batches = self.epoch_batches - self.resume_batches
+        return self.epoch_state(self.resume_batches + num_batches)
+
+    def epoch_state(self, epoch_batches):
+        """State after `epoch_batches` batches of the current epoch."""
+        return {
+            'seed': self.seed,
+            'epoch': max(self.epoch, 0),
+            'cur': epoch_batches * self.batch_size,
+        }
+
+    def set_state(self, state):
+        """Restores a position saved by get_state; the following batches
+        are the same, augmentation included, as in the original run."""
+        if self.workers is not None:
+            self.workers.drain()
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.build_seq()
+        self.cur = state['cur']
+        self.epoch_batches = self.cur // self.batch_size
+        self.resume_batches = self.epoch_batches
+        self.is_init = True
 
     def num_samples(self):
         return len(self.seq)
 
+    def num_buffers(self):
+        """Host batches recycled by this iterator, see BatchBufferRing."""
+        if self.workers is not None:
+            return self.workers.batch_buffers
+        return len(self.buffers.host)
+
+    def load_imglist(self, path_imglist, path_root, images_filter):
+        """Indexes the images of a .lst file or of an image folder.
+
+        A .lst file is parsed with face_preprocess.parse_lst_line; entries
+        that are not aligned are aligned at load time from their landmarks
+        or bounding box. A folder holds one sub-directory per identity,
+        labelled in sorted order. The occlusion mask of an image, if any, is
+        the PNG next to it, see image_mask_path. Images are sorted by label
+        and `imgidx` are positions in `imglist`.
+        """
+        import face_preprocess
+        entries = []
+        if os.path.isdir(path_imglist):
+            logging.info('loading image folder %s...', path_imglist)
+            self.path_root = path_root or path_imglist
+            identities = sorted(
+                d for d in os.listdir(path_imglist)
+                if os.path.isdir(os.path.join(path_imglist, d)))
+            for label, identity in enumerate(identities):
+                for fname in sorted(
+                        os.listdir(os.path.join(path_imglist, identity))):
+                    if fname.lower().endswith(IMAGE_EXTS) and \
+                            not fname.endswith(MASK_SUFFIX):
+                        entries.append((label, os.path.join(identity, fname),
+                                        None, None))
+        else:
+            logging.info('loading image list %s...', path_imglist)
+            self.path_root = path_root or os.path.dirname(path_imglist)
+            with open(path_imglist) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    fname, label, bbox, landmark, aligned = \
+                        face_preprocess.parse_lst_line(line)
+                    if aligned:
+                        bbox, landmark = None, None
+                    entries.append((label, fname, bbox, landmark))
+        entries.sort(key=lambda e: (e[0], e[1]))
+        labels = np.array([e[0] for e in entries], dtype=np.int64)
+        starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+        ends = np.r_[starts[1:], len(labels)]
+        keep = (ends - starts) >= images_filter
+        self.imglist = []
+        self.id2range = {}
+        bounds = [0]
+        for a, b in zip(starts[keep].tolist(), ends[keep].tolist()):
+            self.id2range[int(labels[a])] = (len(self.imglist),
+                                             len(self.imglist) + b - a)
+            self.imglist += entries[a:b]
+            bounds.append(len(self.imglist))
+        assert len(self.imglist) > 0, 'no images in %s' % path_imglist
+        self.header0 = (int(labels.min()), int(labels.max()) + 1)
+        self.seq_identity = range(self.header0[0], self.header0[1])
+        self.imgidx = np.arange(len(self.imglist), dtype=np.int64)
+        self.unit_bounds = np.array(bounds, dtype=np.int64)
+        print('id2range', len(self.id2range), 'images', len(self.imglist))
+
     def next_sample(self):
         """Helper function for reading in next sample."""
         #set total batch size, for example, 1800, and maximum size for each people, for example 45
@@ -134,39 +403,15 @@ class FaceImageIter(io.DataIter):
             header, img = recordio.unpack(s)
             return header.label, img, None, None
 
-    def brightness_aug(self, src, x):
-        alpha = 1.0 + random.uniform(-x, x)
-        src *= alpha
-        return src
-
-    def contrast_aug(self, src, x):
-        alpha = 1.0 + random.uniform(-x, x)
-        coef = nd.array([[[0.299, 0.587, 0.114]]])
-        gray = src * coef
-        gray = (3.0 * (1.0 - alpha) / gray.size) * nd.sum(gray)
-        src *= alpha
-        src += gray
-        return src
-
-    def saturation_aug(self, src, x):
-        alpha = 1.0 + random.uniform(-x, x)
-        coef = nd.array([[[0.299, 0.587, 0.114]]])
-        gray = src * coef
-        gray = nd.sum(gray, axis=2, keepdims=True)
-        gray *= (1.0 - alpha)
-        src *= alpha
-        src += gray
-        return src
-
-    def color_aug(self, img, x):
-        #augs = [self.brightness_aug, self.contrast_aug, self.saturation_aug]
-        #random.shuffle(augs)
-        #for aug in augs:
-        #  #print(img.shape)
-        #  img = aug(img, x)
-        #  #print(img.shape)
-        #return img
-        return self.CJA(img)
+    def next_indices(self):
+        """Returns the record indices of the next full batch and the seed
+        of its augmentation."""
+        if self.cur + self.batch_size > len(self.seq):
+            raise StopIteration
+        indices = self.seq[self.cur:self.cur + self.batch_size]
+        seed = [self.seed, self.epoch, self.cur // self.batch_size]
+        self.cur += self.batch_size
+        return indices, seed
 
     def mirror_aug(self, img):
         _rd = random.randint(0, 1)
@@ -175,16 +420,151 @@ class FaceImageIter(io.DataIter):
                 img[:, :, c] = np.fliplr(img[:, :, c])
         return img
 
-    def compress_aug(self, img):
-        from PIL import Image
-        from io import BytesIO
-        buf = BytesIO()
-        img = Image.fromarray(img.asnumpy(), 'RGB')
-        q = random.randint(2, 20)
-        img.save(buf, format='JPEG', quality=q)
-        buf = buf.getvalue()
-        img = Image.open(BytesIO(buf))
-        return nd.array(np.asarray(img, 'float32'))
+    def decode_batch(self, indices, imgs, labels, masks):
+        """Reads and decodes the records in `indices` into the RGB uint8
+        (N,H,W,3) `imgs`, float32 (N,) `labels` and (N,1,H,W) `masks`.
+
+        With a memmap store the batch is a plain gather without decoding.
+        Masks come from the bit-packed sidecar when there is one, otherwise
+        from `header.label[2:]`. Undecodable records are replaced by the
+        previous valid sample of the batch, or the first one at its start.
+        """
+        c, h, w = self.data_shape
+        timer = self.timer
+        if self.memmap is not None:
+            with timer('read'):
+                ok = self.memmap.read_batch(indices, imgs, labels, masks)
+            if not ok.all():
+                self.fill_invalid(ok, imgs, labels, masks)
+            return
+        if self.imgrec is None:
+            with timer('read'):
+                self.read_list_batch(indices, imgs, labels, masks)
+            return
+        with timer('read'):
+            records = [self.imgrec.read_idx(int(idx)) for idx in indices]
+        with timer('unpack'):
+            records = [recordio.unpack(s) for s in records]
+        invalid = []
+        with timer('decode'):
+            for i, (_, s) in enumerate(records):
+                try:
+                    _data = self.imdecode(s)
+                    self.check_valid_image([_data])
+                except RuntimeError as e:
+                    logging.debug('Invalid image, skipping:  %s', str(e))
+                    invalid.append(i)
+                    continue
+                imgs[i] = _data
+        with timer('mask'):
+            if self.maskrec is not None:
+                masks[:] = self.maskrec.read_batch(indices)
+            for i, (header, _) in enumerate(records):
+                label = header.label
+                if isinstance(label, numbers.Number):
+                    labels[i] = label
+                    if self.maskrec is None:
+                        # the buffers are reused, clean records need zeros
+                        masks[i] = 0
+                else:
+                    labels[i] = label[0]
+                    if self.maskrec is None:
+                        if len(label) >= 2 + h * w:
+                            masks[i] = label[2:2 + h * w].reshape((1, h, w))
+                        else:
+                            masks[i] = 0
+        if invalid:
+            ok = np.ones((len(indices), ), dtype=bool)
+            ok[invalid] = False
+            self.fill_invalid(ok, imgs, labels, masks)
+
+    def fill_invalid(self, ok, imgs, labels, masks):
+        """Replaces the rows that are not `ok` by the nearest previous valid
+        row, or the first valid one; raises if no row is valid."""
+        valid = [i for i in range(len(ok)) if ok[i]]
+        if len(valid) == 0:
+            raise RuntimeError('no valid image in batch')
+        for i in range(len(ok)):
+            if not ok[i]:
+                j = max([v for v in valid if v < i] or valid[:1])
+                imgs[i] = imgs[j]
+                labels[i] = labels[j]
+                masks[i] = masks[j]
+
+    def read_list_batch(self, indices, imgs, labels, masks):
+        """decode_batch for image files: the files are read and decoded on
+        a thread pool, OpenCV releases the GIL while decoding."""
+        pool = self.pool.get()
+        futures = [
+            pool.submit(self.read_list_image, i, int(idx), imgs, labels, masks)
+            for i, idx in enumerate(indices)
+        ]
+        ok = [future.result() for future in futures]
+        self.fill_invalid(ok, imgs, labels, masks)
+
+    def read_list_image(self, i, idx, imgs, labels, masks):
+        """Reads image `idx` of the list and its mask into row `i`.
+        Returns False when the image cannot be decoded."""
+        import face_preprocess
+        c, h, w = self.data_shape
+        label, fname, bbox, landmark = self.imglist[idx]
+        path = os.path.join(self.path_root, fname)
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None:
+            logging.debug('Invalid image, skipping:  %s', path)
+            return False
+        mask = None
+        # most images have no mask, OpenCV warns on every missing file
+        if os.path.exists(image_mask_path(path)):
+            mask = cv2.imread(image_mask_path(path), cv2.IMREAD_GRAYSCALE)
+        if bbox is not None or landmark is not None:
+            img = face_preprocess.preprocess(img,
+                                             bbox=bbox,
+                                             landmark=landmark,
+                                             image_size=self.image_size)
+            if mask is not None:
+                mask = face_preprocess.preprocess(mask[:, :, np.newaxis],
+                                                  bbox=bbox,
+                                                  landmark=landmark,
+                                                  image_size=self.image_size)
+        if img.shape[0] != h or img.shape[1] != w:
+            img = cv2.resize(img, (w, h))
+        imgs[i] = img[:, :, ::-1]
+        labels[i] = label
+        if mask is None:
+            masks[i] = 0
+        else:
+            mask = mask.reshape(mask.shape[:2])
+            if mask.shape[0] != h or mask.shape[1] != w:
+                mask = cv2.resize(mask, (w, h),
+                                  interpolation=cv2.INTER_NEAREST)
+            masks[i, 0] = mask > 127
+        return True
+
+    def load_batch(self, indices, seed, out=None):
+        """Reads, decodes and augments the records in `indices`.
+
+        Results are written into `out`, a (data, label, mask) tuple of
+        float32 arrays shaped (N,C,H,W), (N,) and (N,1,H,W); new arrays are
+        allocated when it is None.
+        """
+        c, h, w = self.data_shape
+        n = len(indices)
+        if out is None:
+            out = (np.empty((n, c, h, w), dtype=np.float32),
+                   np.empty((n, ), dtype=np.float32),
+                   np.empty((n, 1, h, w), dtype=np.float32))
+        batch_data, batch_label, batch_mask = out
+        if self.decode_buffer is None or self.decode_buffer.shape[0] != n:
+            self.decode_buffer = np.empty((n, h, w, c), dtype=np.uint8)
+        imgs = self.decode_buffer
+        self.decode_batch(indices, imgs, batch_label, batch_mask)
+        rng = np.random.RandomState(seed)
+        with self.timer('aug'):
+            data = self.augmenter.augment(imgs, batch_mask, rng, keys=indices)
+        with self.timer('assembly'):
+            self.augmenter.assemble(data, out=batch_data)
+        return out
 
     def next(self):
         if not self.is_init:
@@ -193,71 +573,15 @@ class FaceImageIter(io.DataIter):
         """Returns the next batch of data."""
         #print('in next', self.cur, self.labelcur)
         self.nbatch += 1
-        batch_size = self.batch_size
-        c, h, w = self.data_shape
-        batch_data = nd.empty((batch_size, c, h, w))
-        if self.provide_label is not None:
-            batch_label = nd.empty(self.provide_label[0][1])
-            batch_mask = nd.empty((batch_size,1,h,w))
-        i = 0
-        try:
-            while i < batch_size:
-                label, s, bbox, landmark = self.next_sample()
-                _label_mask = label[2:].reshape((1,h,w))
-                _data = self.imdecode(s)
-                if _data.shape[0] != self.data_shape[1]:
-                    _data = mx.image.resize_short(_data, self.data_shape[1])
-                if self.rand_mirror:
-                    _rd = random.randint(0, 1)
-                    if _rd == 1:
-                        _data = mx.ndarray.flip(data=_data, axis=1)
-                        _label_mask = mx.ndarray.flip(data=nd.array(_label_mask), axis=2)
-                if self.color_jittering > 0:
-                    if self.color_jittering > 1:
-                        _rd = random.randint(0, 1)
-                        if _rd == 1:
-                            _data = self.compress_aug(_data)
-                    #print('do color aug')
-                    _data = _data.astype('float32', copy=False)
-                    #print(_data.__class__)
-                    _data = self.color_aug(_data, 0.125)
-                if self.nd_mean is not None:
-                    _data = _data.astype('float32', copy=False)
-                    _data -= self.nd_mean
-                    _data *= 0.0078125
-                if self.cutoff > 0:
-                    _rd = random.randint(0, 1)
-                    if _rd == 1:
-                        #print('do cutoff aug', self.cutoff)
-                        centerh = random.randint(0, _data.shape[0] - 1)
-                        centerw = random.randint(0, _data.shape[1] - 1)
-                        half = self.cutoff // 2
-                        starth = max(0, centerh - half)
-                        endh = min(_data.shape[0], centerh + half)
-                        startw = max(0, centerw - half)
-                        endw = min(_data.shape[1], centerw + half)
-                        #print(starth, endh, startw, endw, _data.shape)
-                        _data[starth:endh, startw:endw, :] = 128
-                data = [_data]
-                try:
-                    self.check_valid_image(data)
-                except RuntimeError as e:
-                    logging.debug('Invalid image, skipping:  %s', str(e))
-                    continue
-                #print('aa',data[0].shape)
-                #data = self.augmentation_transform(data)
-                #print('bb',data[0].shape)
-                for datum in data:
-                    assert i < batch_size, 'Batch size must be multiples of augmenter output length'
-                    batch_data[i][:] = self.postprocess_data(datum)
-                    batch_label[i][:] = label[0]
-                    batch_mask[i][:] = _label_mask
-                    i += 1
-        except StopIteration:
-            if i < batch_size:
-                raise StopIteration
-
-        return io.DataBatch([batch_data], [batch_label,batch_mask], batch_size - i)
+        if self.workers is not None:
+            return self.workers.next()
+        indices, seed = self.next_indices()
+        # time spent until the consumer released the oldest buffer
+        with self.timer('wait'):
+            host, arrays = self.buffers.acquire()
+        self.load_batch(indices, seed, out=host)
+        self.epoch_batches += 1
+        return io.DataBatch([arrays[0]], [arrays[1], arrays[2]], 0)
 
     def check_data_shape(self, data_shape):
         """Checks if the input data shape is valid"""
@@ -274,9 +598,18 @@ class FaceImageIter(io.DataIter):
             raise RuntimeError('Data shape is wrong')
 
     def imdecode(self, s):
-        """Decodes a string or byte string to an NDArray.
-        See mx.img.imdecode for more details."""
-        img = mx.image.imdecode(s)  #mx.ndarray
+        """Decodes a string or byte string to an RGB uint8 numpy array.
+
+        OpenCV is used instead of mx.image.imdecode so that decoding does not
+        go through the MXNet engine, which must not be used in forked workers.
+        Any payload format of image_codec is accepted.
+        """
+        img = image_codec.decode(s)
+        if img is None:
+            raise RuntimeError('Failed to decode image')
+        img = img[:, :, ::-1]
+        if img.shape[0] != self.data_shape[1] or img.shape[1] != self.data_shape[2]:
+            img = cv2.resize(img, (self.data_shape[2], self.data_shape[1]))
         return img
 
     def read_image(self, fname):
@@ -298,7 +631,322 @@ class FaceImageIter(io.DataIter):
 
     def postprocess_data(self, datum):
         """Final postprocessing step before image is loaded into the batch."""
-        return nd.transpose(datum, axes=(2, 0, 1))
+        return np.transpose(datum, axes=(2, 0, 1))
+
+
+class StageTimer(object):
+    """Collects the wall time of named pipeline stages:
+
+        with timer('decode'):
+            ...
+
+    Disabled (the default) it only costs a flag check per stage.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.times = {}
+        self.stage = None
+        self.tic = 0.0
+
+    def __call__(self, stage):
+        self.stage = stage
+        return self
+
+    def __enter__(self):
+        if self.enabled:
+            self.tic = time.time()
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            self.times.setdefault(self.stage,
+                                  []).append(time.time() - self.tic)
+
+    def reset(self):
+        self.times = {}
+
+
+def wrap_host_batch(host):
+    """Zero-copy NDArrays sharing memory with the numpy arrays in `host`."""
+    arrays = []
+    for x in host:
+        arrays.append(nd.from_numpy(x, zero_copy=True))
+        # from_numpy marks the array read-only; batches are written into it
+        # again once the engine is done with them, see wait_released
+        x.flags['WRITEABLE'] = True
+    return arrays
+
+
+def wait_released(arrays):
+    """Blocks until the engine has no pending operation on `arrays`.
+
+    A one-row engine write is ordered after all pending reads of the
+    buffer, e.g. the executor copy in Module.forward, so waiting for it
+    means the host memory may be overwritten.
+    """
+    for a in arrays:
+        a[0:1] = 0
+        a.wait_to_read()
+
+
+class BatchBufferRing(object):
+    """Ring of preallocated host batches handed out as zero-copy NDArrays.
+
+    A buffer is reused after `size - 1` newer batches were handed out, so
+    a consumer may hold at most that many batches at once (the prefetch
+    depth plus the batch in use).
+    """
+    def __init__(self, batch_size, data_shape, size):
+        c, h, w = data_shape
+        self.host = []
+        self.arrays = []
+        for _ in range(max(size, 2)):
+            host = (np.empty((batch_size, c, h, w), dtype=np.float32),
+                    np.empty((batch_size, ), dtype=np.float32),
+                    np.empty((batch_size, 1, h, w), dtype=np.float32))
+            self.host.append(host)
+            self.arrays.append(wrap_host_batch(host))
+        self.cur = 0
+
+    def acquire(self):
+        """Returns (host, arrays) of the oldest buffer."""
+        i = self.cur
+        self.cur = (i + 1) % len(self.host)
+        wait_released(self.arrays[i])
+        return self.host[i], self.arrays[i]
+
+
+def _batch_worker_loop(data_iter, slots, task_queue, result_queue):
+    """Worker process body: fills shared memory slots with whole batches.
+    The record reader is inherited from the parent, it is fork-safe."""
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        batch_no, slot, indices, seed = task
+        try:
+            data_iter.load_batch(indices, seed, out=slots[slot])
+            result_queue.put((batch_no, slot, None))
+        except Exception:
+            result_queue.put((batch_no, slot, traceback.format_exc()))
+
+
+class FaceBatchWorkers(object):
+    """Pool of forked processes that produce whole batches for a
+    FaceImageIter.
+
+    Every worker inherits the parent's MmapIndexedRecordIO, which has no
+    file handle or seek position and is safe to read from forked
+    processes, and writes its batch into one of `num_slots` shared memory
+    slots. Batches are returned in the order they were submitted, as
+    zero-copy NDArrays over the slot memory; like BatchBufferRing, a slot
+    is recycled after `batch_buffers - 1` newer batches were handed out.
+    """
+    def __init__(self, data_iter, num_workers, num_slots=0, batch_buffers=4):
+        self.data_iter = data_iter
+        self.num_workers = num_workers
+        self.batch_buffers = max(batch_buffers, 2)
+        if num_slots <= 0:
+            num_slots = 2 * num_workers + self.batch_buffers
+        self.num_slots = num_slots
+        batch_size = data_iter.batch_size
+        c, h, w = data_iter.data_shape
+        ctx = multiprocessing.get_context('fork')
+        self.slots = []
+        for _ in range(num_slots):
+            data = ctx.RawArray('f', batch_size * c * h * w)
+            label = ctx.RawArray('f', batch_size)
+            mask = ctx.RawArray('f', batch_size * h * w)
+            self.slots.append(
+                (np.frombuffer(data, dtype=np.float32).reshape(
+                    (batch_size, c, h, w)),
+                 np.frombuffer(label, dtype=np.float32),
+                 np.frombuffer(mask, dtype=np.float32).reshape(
+                     (batch_size, 1, h, w))))
+        self.arrays = [wrap_host_batch(slot) for slot in self.slots]
+        self.handed_out = []
+        self.task_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.free_slots = list(range(num_slots))
+        self.results = {}
+        self.sent = 0
+        self.rcvd = 0
+        self.procs = []
+        for _ in range(num_workers):
+            p = ctx.Process(target=_batch_worker_loop,
+                            args=(data_iter, self.slots, self.task_queue,
+                                  self.result_queue))
+            p.daemon = True
+            p.start()
+            self.procs.append(p)
+        logging.info('started %d data workers with %d batch slots',
+                     num_workers, num_slots)
+
+    def pending(self):
+        return self.sent - self.rcvd
+
+    def submit(self):
+        """Hands batches to the workers while there are free slots.
+        Returns False once the epoch has no full batch left."""
+        while len(self.free_slots) > 0:
+            try:
+                indices, seed = self.data_iter.next_indices()
+            except StopIteration:
+                return False
+            slot = self.free_slots.pop()
+            self.task_queue.put((self.sent, slot, list(indices), seed))
+            self.sent += 1
+        return True
+
+    def get(self):
+        """Waits for the oldest submitted batch and returns its slot."""
+        while self.rcvd not in self.results:
+            batch_no, slot, err = self.result_queue.get()
+            if err is not None:
+                raise RuntimeError('data worker failed:\n%s' % err)
+            self.results[batch_no] = slot
+        slot = self.results.pop(self.rcvd)
+        self.rcvd += 1
+        return slot
+
+    def next(self):
+        self.submit()
+        if self.pending() == 0:
+            raise StopIteration
+        slot = self.get()
+        arrays = self.arrays[slot]
+        self.handed_out.append(slot)
+        if len(self.handed_out) >= self.batch_buffers:
+            self.recycle()
+        self.data_iter.epoch_batches += 1
+        return io.DataBatch([arrays[0]], [arrays[1], arrays[2]], 0)
+
+    def recycle(self):
+        """Returns the oldest handed out slot to the workers."""
+        slot = self.handed_out.pop(0)
+        wait_released(self.arrays[slot])
+        self.free_slots.append(slot)
+
+    def drain(self):
+        """Discards all batches still in flight, e.g. on reset."""
+        while self.pending() > 0:
+            self.free_slots.append(self.get())
+
+    def close(self):
+        for _ in self.procs:
+            self.task_queue.put(None)
+        for p in self.procs:
+            p.join()
+        self.procs = []
+
+
+class FacePrefetchIter(io.DataIter):
+    """Prefetches up to `depth` batches of `data_iter` in a background
+    thread.
+
+    Replaces mx.io.PrefetchingIter, which buffers a single batch. The
+    queue occupancy seen by the consumer is accumulated, see stats(), so
+    the training log shows when the model waits for input. With
+    BatchBufferRing the wrapped iterator needs at least depth + 3 batch
+    buffers: the queue, the batch being produced and two held by
+    Module.fit.
+    """
+    def __init__(self, data_iter, depth=4):
+        super(FacePrefetchIter, self).__init__(data_iter.batch_size)
+        # an unbounded queue would let the producer overwrite queued
+        # batches of the buffer ring
+        assert depth >= 1, 'prefetch depth must be at least 1'
+        if hasattr(data_iter, 'num_buffers'):
+            assert data_iter.num_buffers() >= depth + 3, \
+                'prefetch depth %d needs at least %d batch buffers, got %d' % (
+                    depth, depth + 3, data_iter.num_buffers())
+        self.data_iter = data_iter
+        self.provide_data = data_iter.provide_data
+        self.provide_label = data_iter.provide_label
+        self.depth = depth
+        self.queue = queue.Queue(maxsize=depth)
+        self.thread = None
+        self.stopping = False
+        self.exhausted = False
+        self.reset_stats()
+        self.start()
+
+    def _produce(self):
+        try:
+            while not self.stopping:
+                self.queue.put(self.data_iter.next())
+        except StopIteration:
+            self.queue.put(None)
+        except Exception as e:
+            logging.exception('prefetch thread failed')
+            self.queue.put(e)
+
+    def start(self):
+        self.stopping = False
+        self.exhausted = False
+        self.thread = threading.Thread(target=self._produce)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping = True
+        # keep taking batches so that a blocked put() returns
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.thread.join()
+        while not self.queue.empty():
+            self.queue.get()
+        self.thread = None
+
+    def reset(self):
+        self.stop()
+        self.data_iter.reset()
+        self.start()
+
+    def next(self):
+        if self.exhausted:
+            raise StopIteration
+        size = self.queue.qsize()
+        self.occupancy += size
+        self.num_batches += 1
+        if size == 0:
+            self.starved += 1
+            tic = time.time()
+            item = self.queue.get()
+            self.wait_time += time.time() - tic
+        else:
+            item = self.queue.get()
+        if item is None:
+            self.exhausted = True
+            raise StopIteration
+        if isinstance(item, Exception):
+            self.exhausted = True
+            raise item
+        return item
+
+    def reset_stats(self):
+        self.occupancy = 0
+        self.num_batches = 0
+        self.starved = 0
+        self.wait_time = 0.0
+
+    def stats(self, reset=True):
+        """Queue statistics since the last call: mean occupancy, batches
+        that found the queue empty, and seconds spent waiting for them."""
+        ret = {
+            'depth': self.depth,
+            'batches': self.num_batches,
+            'mean_occupancy': self.occupancy / max(self.num_batches, 1),
+            'starved': self.starved,
+            'wait_time': self.wait_time,
+        }
+        if reset:
+            self.reset_stats()
+        return ret
 
 
 class FaceImageIterList(io.DataIter):
@@ -310,7 +958,8 @@ class FaceImageIterList(io.DataIter):
         self.cur_iter = None
 
     def reset(self):
-        self.cur_iter.reset()
+        for it in self.iter_list:
+            it.reset()
 
     def next(self):
         self.cur_iter = random.choice(self.iter_list)
@@ -321,3 +970,119 @@ class FaceImageIterList(io.DataIter):
                 self.cur_iter.reset()
                 continue
             return ret
+
+
+class FaceMixIter(io.DataIter):
+    """Builds every batch from several sources in fixed proportions.
+
+    `iter_list` are FaceImageIters whose batch sizes are the per-device
+    shares of each source (see sampler.mix_batch_sizes) times `ctx_num`; the rows
+    are interleaved so that every device slice holds the same mix. Each
+    source is prefetched by its own FacePrefetchIter, so a slow source only
+    delays the batches it contributes to. The labels of source i are
+    shifted by `label_offsets[i]` into one class space. The epoch follows
+    the first source; the others start a new epoch whenever they run out.
+    """
+    def __init__(self, iter_list, label_offsets, ctx_num=1, depth=4):
+        assert len(iter_list) > 0
+        assert len(label_offsets) == len(iter_list)
+        sizes = [it.batch_size for it in iter_list]
+        for size in sizes:
+            assert size > 0 and size % ctx_num == 0
+        batch_size = sum(sizes)
+        super(FaceMixIter, self).__init__(batch_size)
+        self.iter_list = iter_list
+        self.label_offsets = label_offsets
+        self.ctx_num = ctx_num
+        data_name, data_shape = iter_list[0].provide_data[0]
+        self.provide_data = [(data_name, (batch_size, ) + tuple(data_shape[1:]))]
+        self.provide_label = [(name, (batch_size, ) + tuple(shape[1:]))
+                              for name, shape in iter_list[0].provide_label]
+        self.order = None
+        if ctx_num > 1 and len(sizes) > 1:
+            # row of the concatenated batch for every row of the mixed one
+            begins = np.cumsum([0] + sizes)
+            order = []
+            for k in range(ctx_num):
+                for i, size in enumerate(sizes):
+                    per = size // ctx_num
+                    order.append(np.arange(begins[i] + k * per,
+                                           begins[i] + (k + 1) * per))
+            self.order = nd.array(np.concatenate(order), dtype=np.int32)
+        for it in iter_list:
+            if not it.is_init:
+                it.reset()
+                it.is_init = True
+        self.sources = [FacePrefetchIter(it, depth=depth) for it in iter_list]
+        self.batches = 0
+        self.resume_batches = 0
+        # per source: (mixed batch, source epoch, source batch) at which the
+        # source (re)started, to map trainer positions back in get_state;
+        # all counted from the start of the epoch
+        self.starts = [[(0, it.epoch, 0)] for it in iter_list]
+
+    def reset(self):
+        for source in self.sources:
+            source.reset()
+        self.batches = 0
+        self.resume_batches = 0
+        self.starts = [[(0, it.epoch, 0)] for it in self.iter_list]
+
+    def next(self):
+        batches = []
+        for i, source in enumerate(self.sources):
+            try:
+                batch = source.next()
+            except StopIteration:
+                if i == 0:
+                    raise
+                source.reset()
+                self.starts[i].append((self.batches, self.iter_list[i].epoch,
+                                       0))
+                batch = source.next()
+            batches.append(batch)
+        data = nd.concat(*[b.data[0] for b in batches], dim=0)
+        label = nd.concat(*[
+            b.label[0] + offset
+            for b, offset in zip(batches, self.label_offsets)
+        ], dim=0)
+        mask = nd.concat(*[b.label[1] for b in batches], dim=0)
+        if self.order is not None:
+            data = nd.take(data, self.order)
+            label = nd.take(label, self.order)
+            mask = nd.take(mask, self.order)
+        self.batches += 1
+        return io.DataBatch([data], [label, mask], 0)
+
+    def get_state(self, num_batches=None):
+        """Per-source positions after `num_batches` mixed batches, counted
+        like FaceImageIter.get_state."""
+        if num_batches is None:
+            num_batches = self.batches - self.resume_batches
+        num_batches += self.resume_batches
+        states = []
+        for it, starts in zip(self.iter_list, self.starts):
+            k, epoch, offset = [s for s in starts if s[0] <= num_batches][-1]
+            state = it.epoch_state(offset + num_batches - k)
+            state['epoch'] = epoch
+            states.append(state)
+        return {'sources': states}
+
+    def set_state(self, state):
+        states = state['sources']
+        assert len(states) == len(self.iter_list)
+        for source in self.sources:
+            source.stop()
+        for it, s in zip(self.iter_list, states):
+            it.set_state(s)
+        first = self.iter_list[0]
+        self.batches = first.cur // first.batch_size
+        self.resume_batches = self.batches
+        self.starts = [[(self.batches, it.epoch, it.cur // it.batch_size)]
+                       for it in self.iter_list]
+        for source in self.sources:
+            source.start()
+
+    def stats(self, reset=True):
+        """Queue statistics of every source, see FacePrefetchIter.stats."""
+        return [source.stats(reset) for source in self.sources]
@@ -0,0 +1,103 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import logging
+import numpy as np
+import cv2
+
+# vertical range of the occluder center, as a fraction of the image height,
+# by file name prefix; anything else may land anywhere on the face
+PLACEMENT = {
+    'mask': (0.65, 0.85),
+    'glasses': (0.35, 0.50),
+    'sunglasses': (0.35, 0.50),
+    'hat': (0.05, 0.25),
+    'scarf': (0.75, 0.95),
+}
+DEFAULT_PLACEMENT = (0.20, 0.90)
+
+
+class OcclusionAugmenter(object):
+    """Composites occluder textures onto clean faces and updates the
+    occlusion masks accordingly.
+
+    `occluder_dir` holds RGBA PNGs (face masks, glasses, hands, ...). The
+    file name prefix, e.g. mask_03.png, selects where the occluder is
+    placed, see PLACEMENT. Each texture is resized once per scale into a
+    bank of HxWx4 patches; a batch is then occluded with one gather and one
+    alpha blend over all samples. Occluded pixels get `mask_value` in the
+    mask.
+    """
+    def __init__(self,
+                 occluder_dir,
+                 image_size=(112, 112),
+                 prob=0.5,
+                 scales=(0.45, 0.6, 0.75),
+                 mask_value=1.0):
+        self.image_size = image_size
+        self.prob = prob
+        self.mask_value = mask_value
+        h, w = image_size
+        bank = []
+        sizes = []
+        centers = []
+        for fname in sorted(os.listdir(occluder_dir)):
+            if not fname.lower().endswith('.png'):
+                continue
+            img = cv2.imread(os.path.join(occluder_dir, fname),
+                             cv2.IMREAD_UNCHANGED)
+            if img is None or img.ndim != 3 or img.shape[2] != 4:
+                logging.warning('skipping occluder without alpha: %s', fname)
+                continue
+            img = img[:, :, [2, 1, 0, 3]]  # BGRA to RGBA
+            prefix = fname.split('_')[0].split('.')[0].lower()
+            placement = PLACEMENT.get(prefix, DEFAULT_PLACEMENT)
+            for scale in scales:
+                pw = int(round(w * scale))
+                ph = int(round(pw * img.shape[0] / float(img.shape[1])))
+                ph = min(max(ph, 1), h)
+                patch = np.zeros((h, w, 4), dtype=np.uint8)
+                patch[:ph, :pw] = cv2.resize(img, (pw, ph),
+                                             interpolation=cv2.INTER_AREA)
+                bank.append(patch)
+                sizes.append((ph, pw))
+                centers.append(placement)
+        assert len(bank) > 0, 'no RGBA occluders in %s' % occluder_dir
+        self.bank = np.stack(bank)
+        self.sizes = np.array(sizes, dtype=np.int64)
+        self.centers = np.array(centers, dtype=np.float32)
+        logging.info('loaded %d occluder patches from %s', len(bank),
+                     occluder_dir)
+
+    def __call__(self, imgs, masks, rng):
+        """Occludes RGB uint8 (N,H,W,3) `imgs` and float32 (N,1,H,W)
+        `masks` in place."""
+        n, h, w = imgs.shape[:3]
+        sel = np.flatnonzero(rng.uniform(size=n) < self.prob)
+        if len(sel) == 0:
+            return
+        k = rng.randint(0, len(self.bank), size=len(sel))
+        ph, pw = self.sizes[k, 0], self.sizes[k, 1]
+        lo, hi = self.centers[k, 0], self.centers[k, 1]
+        cy = (lo + (hi - lo) * rng.uniform(size=len(sel))) * h
+        cx = rng.uniform(0.3, 0.7, size=len(sel)) * w
+        oy = np.round(cy - ph / 2.0).astype(np.int64)
+        ox = np.round(cx - pw / 2.0).astype(np.int64)
+        # canvas pixel (y, x) of sample i shows patch pixel (y-oy, x-ox)
+        ys = np.arange(h)[np.newaxis, :] - oy[:, np.newaxis]
+        xs = np.arange(w)[np.newaxis, :] - ox[:, np.newaxis]
+        vy = (ys >= 0) & (ys < ph[:, np.newaxis])
+        vx = (xs >= 0) & (xs < pw[:, np.newaxis])
+        ys = np.clip(ys, 0, h - 1)
+        xs = np.clip(xs, 0, w - 1)
+        occ = self.bank[k[:, None, None], ys[:, :, None], xs[:, None, :]]
+        alpha = occ[..., 3].astype(np.float32) / 255.0
+        alpha *= vy[:, :, None] & vx[:, None, :]
+        blend = imgs[sel].astype(np.float32)
+        blend += alpha[..., np.newaxis] * (occ[..., :3] - blend)
+        imgs[sel] = np.clip(blend + 0.5, 0, 255).astype(np.uint8)
+        m = masks[sel]
+        m[:, 0][alpha > 0.5] = self.mask_value
+        masks[sel] = m
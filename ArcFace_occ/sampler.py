@@ -0,0 +1,175 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+def full_shuffle(seq, rng):
+    """Uniform shuffle of all record indices."""
+    seq = np.array(seq, dtype=np.int64)
+    rng.shuffle(seq)
+    return seq
+
+
+def block_shuffle(seq, block_size, buffer_size, rng):
+    """Shuffle that keeps reads mostly sequential.
+
+    The record indices are sorted into file order and cut into blocks of
+    `block_size` contiguous records. Blocks are visited in random order and
+    the resulting stream is shuffled within consecutive windows of
+    `buffer_size` records, so at any time only about
+    buffer_size / block_size distinct file regions are being read.
+    """
+    seq = np.sort(np.asarray(seq, dtype=np.int64))
+    if len(seq) == 0:
+        return seq
+    num_blocks = (len(seq) + block_size - 1) // block_size
+    order = rng.permutation(num_blocks)
+    starts = order * block_size
+    stream = np.concatenate(
+        [seq[s:s + block_size] for s in starts.tolist()])
+    buffer_size = max(buffer_size, 1)
+    for begin in range(0, len(stream), buffer_size):
+        rng.shuffle(stream[begin:begin + buffer_size])
+    return stream
+
+
+def partition(imgidx, bounds, num_parts, part_index, rng):
+    """This worker's share of the records for one epoch.
+
+    `bounds` are the (K+1,) start positions in `imgidx` of the units that
+    must not be split, e.g. identities. Units are shuffled with `rng`, which
+    must be seeded identically on every worker, and dealt round-robin. Every
+    share is cut to the size of the smallest one, so all workers run the
+    same number of batches under a dist_sync kvstore.
+    """
+    bounds = np.asarray(bounds, dtype=np.int64)
+    counts = bounds[1:] - bounds[:-1]
+    order = rng.permutation(len(counts))
+    part_of = np.empty((len(counts), ), dtype=np.int64)
+    part_of[order] = np.arange(len(counts)) % num_parts
+    sizes = np.bincount(part_of, weights=counts, minlength=num_parts)
+    units = order[part_index::num_parts]
+    positions = np.concatenate(
+        [np.arange(bounds[u], bounds[u + 1]) for u in units.tolist()] +
+        [np.zeros((0, ), dtype=np.int64)])
+    imgidx = np.asarray(imgidx, dtype=np.int64)
+    return imgidx[positions[:int(sizes.min())]]
+
+
+def mix_batch_sizes(batch_size, weights):
+    """Splits `batch_size` in proportion to `weights`; the largest
+    remainders are rounded up so that the shares add up exactly."""
+    weights = np.asarray(weights, dtype=np.float64)
+    assert (weights >= 0).all() and weights.sum() > 0
+    exact = batch_size * weights / weights.sum()
+    sizes = np.floor(exact).astype(np.int64)
+    rest = int(batch_size - sizes.sum())
+    sizes[np.argsort(sizes - exact, kind='stable')[:rest]] += 1
+    return sizes.tolist()
+
+
+def bucket_shuffle(seq, buckets, batch_size, proportions, rng):
+    """Shuffle in which every batch takes fixed shares from buckets.
+
+    `buckets` is the bucket of every entry of `seq`, e.g. its occlusion
+    ratio bucket, and `proportions` the weight of each bucket. The epoch
+    keeps len(seq) // batch_size batches; a bucket that runs out is
+    reshuffled and reused, so small buckets are oversampled. Empty buckets
+    give their share to the others.
+    """
+    seq = np.asarray(seq, dtype=np.int64)
+    buckets = np.asarray(buckets)
+    num_batches = len(seq) // batch_size
+    members = [seq[buckets == b] for b in range(len(proportions))]
+    weights = [p if len(m) > 0 else 0.0 for p, m in zip(proportions, members)]
+    if num_batches == 0:
+        return seq[:0]
+    shares = mix_batch_sizes(batch_size, weights)
+    columns = []
+    for share, m in zip(shares, members):
+        if share == 0:
+            continue
+        need = num_batches * share
+        stream = np.concatenate(
+            [rng.permutation(m) for _ in range(-(-need // len(m)))])
+        columns.append(stream[:need].reshape((num_batches, share)))
+    batches = np.concatenate(columns, axis=1)
+    # interleave the buckets within every batch
+    order = np.argsort(rng.uniform(size=batches.shape), axis=1)
+    return np.take_along_axis(batches, order, axis=1).reshape(-1)
+
+
+class AliasTable(object):
+    """Vose's alias method: O(K) to build, O(1) per draw from a discrete
+    distribution over K outcomes."""
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        assert len(weights) > 0 and (weights >= 0).all() and weights.sum() > 0
+        k = len(weights)
+        scaled = weights * k / weights.sum()
+        self.prob = np.ones((k, ), dtype=np.float64)
+        self.alias = np.arange(k, dtype=np.int64)
+        small = np.flatnonzero(scaled < 1.0).tolist()
+        large = np.flatnonzero(scaled >= 1.0).tolist()
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # whatever is left is 1 up to rounding and keeps prob 1
+
+    def __len__(self):
+        return len(self.prob)
+
+    def draw(self, n, rng):
+        i = rng.randint(0, len(self.prob), size=n)
+        return np.where(rng.uniform(size=n) < self.prob[i], i, self.alias[i])
+
+
+def identity_weights(counts, mode):
+    """Sampling weight of every identity from its image count: 'uniform',
+    'sqrt' (square root of the frequency) or 'frequency'."""
+    counts = np.asarray(counts, dtype=np.float64)
+    if mode == 'uniform':
+        return np.ones_like(counts)
+    if mode == 'sqrt':
+        return np.sqrt(counts)
+    if mode == 'frequency':
+        return counts
+    raise ValueError('unknown identity weights %s' % mode)
+
+
+def identity_sample(imgidx, starts, counts, num_batches, num_identities,
+                    images_per_identity, weights, rng):
+    """P x K batches over identities.
+
+    Identity u owns imgidx[starts[u]:starts[u] + counts[u]]. Every batch
+    holds `num_identities` distinct identities, as far as the weights
+    allow, drawn from an alias table, with `images_per_identity` images
+    each. The images are stratified over the identity, so they are
+    distinct whenever it has enough of them. Returns the record keys of
+    the batches, one after the other.
+    """
+    imgidx = np.asarray(imgidx, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    p, k = num_identities, images_per_identity
+    table = AliasTable(weights)
+    ids = np.empty((num_batches, p), dtype=np.int64)
+    for b in range(num_batches):
+        drawn = table.draw(2 * p, rng)
+        _, first = np.unique(drawn, return_index=True)
+        drawn = drawn[np.sort(first)]
+        if len(drawn) < p:
+            drawn = np.r_[drawn, table.draw(p - len(drawn), rng)]
+        ids[b] = drawn[:p]
+    strata = (np.arange(k) + rng.uniform(size=(num_batches, p, k))) / k
+    offsets = (strata * counts[ids][:, :, np.newaxis]).astype(np.int64)
+    return imgidx[starts[ids][:, :, np.newaxis] + offsets].reshape(-1)
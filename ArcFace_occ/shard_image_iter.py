@@ -0,0 +1,281 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import random
+import logging
+import tarfile
+import threading
+import queue
+import numpy as np
+import cv2
+
+from mxnet import io
+
+from batch_aug import BatchAugmenter
+from occlusion_aug import OcclusionAugmenter
+from image_iter import BatchBufferRing
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
+import mask_pack
+import image_codec
+from rec2shards import MANIFEST
+
+
+def read_shard(path):
+    """Yields (key, {ext: bytes}) for the samples of a tar shard, reading
+    it front to back without seeking."""
+    key = None
+    sample = {}
+    with tarfile.open(path, 'r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            stem, ext = os.path.splitext(member.name)
+            if stem != key:
+                if key is not None:
+                    yield key, sample
+                key = stem
+                sample = {}
+            sample[ext] = tar.extractfile(member).read()
+    if key is not None:
+        yield key, sample
+
+
+class FaceShardIter(io.DataIter):
+    """Streams training samples from tar shards written by
+    common/rec2shards.py.
+
+    Shards are only ever read sequentially. Every epoch the shard list is
+    shuffled, identically on all workers, split between the `num_parts`
+    distributed workers and then between `num_readers` reader threads,
+    which decode into a shared queue. Samples are drawn at random from a
+    pool of `shuffle_buffer` decoded samples, so throughput grows with the
+    number of readers instead of being bound by seek latency. Batches are
+    augmented and returned like FaceImageIter's.
+    """
+    def __init__(self,
+                 batch_size,
+                 data_shape,
+                 path_shards,
+                 shuffle=False,
+                 mean=None,
+                 rand_mirror=False,
+                 cutoff=0,
+                 color_jittering=0,
+                 num_readers=4,
+                 shuffle_buffer=8192,
+                 seed=None,
+                 batch_buffers=4,
+                 num_parts=1,
+                 part_index=0,
+                 occluder_dir=None,
+                 occlusion_prob=0.5,
+                 data_name='data',
+                 label_name='softmax_label',
+                 **kwargs):
+        super(FaceShardIter, self).__init__(batch_size)
+        logging.info('loading shards %s...', path_shards)
+        with open(os.path.join(path_shards, MANIFEST)) as f:
+            manifest = json.load(f)
+        self.path_shards = path_shards
+        self.header0 = manifest['header0']
+        self.shards = [(s['name'], s['count']) for s in manifest['shards']]
+        assert len(self.shards) >= num_parts, 'fewer shards than workers'
+        print('shards', len(self.shards), 'images',
+              sum(c for _, c in self.shards))
+        self.batch_size = batch_size
+        self.data_shape = data_shape
+        self.provide_data = [(data_name, (batch_size, ) + data_shape)]
+        self.provide_label = [('softmax_label', (batch_size, )),
+                              ('mask_label', (batch_size, ))]
+        self.shuffle = shuffle
+        self.num_readers = num_readers
+        self.shuffle_buffer = shuffle_buffer if shuffle else 1
+        assert 0 <= part_index < num_parts
+        self.num_parts = num_parts
+        self.part_index = part_index
+        if seed is None:
+            # shards are only disjoint when every worker uses the same seed
+            seed = 0 if num_parts > 1 else random.randint(0, 2**31 - 1)
+        self.seed = seed
+        print('data seed', seed)
+        occlusion = None
+        if occluder_dir:
+            occlusion = OcclusionAugmenter(occluder_dir,
+                                           image_size=data_shape[1:],
+                                           prob=occlusion_prob)
+        self.augmenter = BatchAugmenter(rand_mirror=rand_mirror,
+                                        color_jittering=color_jittering,
+                                        mean=mean,
+                                        cutoff=cutoff,
+                                        occlusion=occlusion)
+        c, h, w = data_shape
+        self.buffers = BatchBufferRing(batch_size, data_shape, batch_buffers)
+        self.decode_buffer = np.empty((batch_size, h, w, c), dtype=np.uint8)
+        self.mask_rows = np.zeros((batch_size, mask_pack.row_bytes((h, w))),
+                                  dtype=np.uint8)
+        self.queue = queue.Queue(maxsize=max(4 * batch_size, 256))
+        self.threads = []
+        self.stopping = False
+        self.epoch = -1
+        self.epoch_batches = 0
+        # batches of the epoch already used when set_state resumed it
+        self.resume_batches = 0
+        self.skip = 0
+        self.is_init = False
+
+    def plan_epoch(self):
+        """Shards of this worker for the current epoch, and the number of
+        batches every worker runs."""
+        rng = np.random.RandomState([self.seed, self.epoch])
+        order = np.arange(len(self.shards))
+        if self.shuffle:
+            rng.shuffle(order)
+        counts = np.array([c for _, c in self.shards], dtype=np.int64)
+        per_part = [
+            counts[order[k::self.num_parts]].sum()
+            for k in range(self.num_parts)
+        ]
+        self.num_batches = int(min(per_part)) // self.batch_size
+        return [self.shards[i][0] for i in order[self.part_index::self.num_parts]]
+
+    def _read(self, names):
+        c, h, w = self.data_shape
+        try:
+            for name in names:
+                for key, sample in read_shard(
+                        os.path.join(self.path_shards, name)):
+                    if self.stopping:
+                        return
+                    img = None
+                    for fmt in image_codec.FORMATS:
+                        if '.' + fmt in sample:
+                            img = image_codec.decode(sample['.' + fmt])
+                            break
+                    if img is None:
+                        logging.debug('Invalid image, skipping:  %s', key)
+                        continue
+                    if img.shape[0] != h or img.shape[1] != w:
+                        img = cv2.resize(img, (w, h))
+                    label = int(sample['.cls'])
+                    self.queue.put((img[:, :, ::-1], label,
+                                    sample.get('.mask')))
+        except Exception as e:
+            logging.exception('shard reader failed')
+            self.queue.put(e)
+        finally:
+            self.queue.put(None)
+
+    def start(self):
+        names = self.plan_epoch()
+        self.stopping = False
+        self.pool = []
+        self.rng = np.random.RandomState(
+            [self.seed, self.epoch, self.part_index + 1])
+        self.threads = []
+        for r in range(self.num_readers):
+            t = threading.Thread(target=self._read,
+                                 args=(names[r::self.num_readers], ))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        self.active = len(self.threads)
+
+    def stop(self):
+        self.stopping = True
+        # keep taking samples so that a blocked put() returns
+        while any(t.is_alive() for t in self.threads):
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for t in self.threads:
+            t.join()
+        while not self.queue.empty():
+            self.queue.get()
+        self.threads = []
+
+    def reset(self):
+        """Starts the readers on the next epoch."""
+        print('call reset()')
+        self.stop()
+        self.epoch += 1
+        self.epoch_batches = 0
+        self.resume_batches = 0
+        self.skip = 0
+        self.start()
+
+    def num_buffers(self):
+        return len(self.buffers.host)
+
+    def get_state(self, num_batches=None):
+        """Same fields as FaceImageIter.get_state. The sample order within
+        an epoch depends on reader timing, so a resumed run continues at
+        the same position in the epoch but not with the same samples."""
+        if num_batches is None:
+            num_batches = self.epoch_batches - self.resume_batches
+        return self.epoch_state(self.resume_batches + num_batches)
+
+    def epoch_state(self, epoch_batches):
+        return {
+            'seed': self.seed,
+            'epoch': max(self.epoch, 0),
+            'cur': epoch_batches * self.batch_size,
+        }
+
+    def set_state(self, state):
+        self.stop()
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.epoch_batches = state['cur'] // self.batch_size
+        self.resume_batches = self.epoch_batches
+        self.skip = self.epoch_batches * self.batch_size
+        self.start()
+        self.is_init = True
+
+    def next_sample(self):
+        while len(self.pool) < self.shuffle_buffer and self.active > 0:
+            item = self.queue.get()
+            if item is None:
+                self.active -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                self.pool.append(item)
+        if len(self.pool) == 0:
+            raise StopIteration
+        j = self.rng.randint(0, len(self.pool))
+        self.pool[j], self.pool[-1] = self.pool[-1], self.pool[j]
+        return self.pool.pop()
+
+    def next(self):
+        """Returns the next batch of data."""
+        if not self.is_init:
+            self.reset()
+            self.is_init = True
+        while self.skip > 0:
+            self.next_sample()
+            self.skip -= 1
+        if self.epoch_batches >= self.num_batches:
+            raise StopIteration
+        host, arrays = self.buffers.acquire()
+        imgs = self.decode_buffer
+        labels = host[1]
+        rows = self.mask_rows
+        for i in range(self.batch_size):
+            img, label, mask = self.next_sample()
+            imgs[i] = img
+            labels[i] = label
+            if mask is None:
+                rows[i] = 0
+            else:
+                rows[i] = np.frombuffer(mask, dtype=np.uint8)
+        host[2][:] = mask_pack.unpack_masks(rows, self.data_shape[1:])
+        rng = np.random.RandomState(
+            [self.seed, self.epoch, self.epoch_batches])
+        self.augmenter(imgs, host[2], rng, out=host[0])
+        self.epoch_batches += 1
+        return io.DataBatch([arrays[0]], [arrays[1], arrays[2]], 0)
@@ -9,12 +9,13 @@ import random
 import logging
 import sklearn
 import pickle
+import json
 import numpy as np
 import mxnet as mx
 from mxnet import ndarray as nd
 import argparse
 import mxnet.optimizer as optimizer
-from config import config, default, generate_config
+from config import config, default, generate_config, dataset
 from metric import *
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
 import flops_counter
@@ -293,6 +294,14 @@ def train_net(args):
     config.batch_size = args.batch_size
     config.per_batch_size = args.per_batch_size
 
+    kv = args.kvstore
+    part_index = 0
+    if config.num_workers > 1:
+        # each worker reads its own 1/num_workers of the data
+        kv = mx.kvstore.create(args.kvstore)
+        part_index = kv.rank
+        print('data part', part_index, 'of', config.num_workers)
+
     data_dir = config.dataset_path
     path_imgrec = None
     path_imglist = None
@@ -300,8 +309,16 @@ def train_net(args):
     assert len(image_size) == 2
     assert image_size[0] == image_size[1]
     print('image_size', image_size)
+    if config.data_sources:
+        # the sources' classes are stacked into one label space, in order
+        config.num_classes = sum(dataset[name].num_classes
+                                 for name, _ in config.data_sources)
     print('num_classes', config.num_classes)
     path_imgrec = os.path.join(data_dir, "train.rec")
+    if config.data_imglist:
+        # train straight from an image folder or .lst file
+        path_imgrec = None
+        path_imglist = config.data_imglist
 
     print('Called with argument:', args, config)
     data_shape = (args.image_channel, image_size[0], image_size[1])
@@ -353,6 +370,8 @@ def train_net(args):
             batch_size=args.batch_size,
             data_shape=data_shape,
             path_imgrec=path_imgrec,
+            path_imglist=path_imglist,
+            read_threads=config.data_read_threads,
             shuffle=True,
             rand_mirror=config.data_rand_mirror,
             mean=mean,
@@ -360,23 +379,98 @@ def train_net(args):
             ctx_num=args.ctx_num,
             images_per_identity=config.images_per_identity,
             triplet_params=triplet_params,
+            triplet_metric='angular'
+            if config.loss_name == 'atriplet' else 'euclidean',
             mx_model=model,
+            batch_buffers=max(config.data_batch_buffers,
+                              config.data_prefetch + 3),
         )
         _metric = Id_LossValueMetric()
         eval_metrics = [mx.metric.create(_metric)]
     else:
         from image_iter import FaceImageIter
-        train_dataiter = FaceImageIter(
-            batch_size=args.batch_size,
-            data_shape=data_shape,
-            path_imgrec=path_imgrec,
-            shuffle=True,
-            rand_mirror=config.data_rand_mirror,
-            mean=mean,
-            cutoff=config.data_cutoff,
-            color_jittering=config.data_color,
-            images_filter=config.data_images_filter,
-        )
+
+        def make_dataiter(path_imgrec, batch_size, path_imglist=None):
+            return FaceImageIter(
+                batch_size=batch_size,
+                data_shape=data_shape,
+                path_imgrec=path_imgrec,
+                path_imglist=path_imglist,
+                read_threads=config.data_read_threads,
+                shuffle=True,
+                rand_mirror=config.data_rand_mirror,
+                mean=mean,
+                cutoff=config.data_cutoff,
+                color_jittering=config.data_color,
+                images_filter=config.data_images_filter,
+                data_workers=config.data_workers,
+                data_memmap=config.data_memmap,
+                shuffle_mode=config.data_shuffle,
+                shuffle_block=config.data_shuffle_block,
+                shuffle_buffer=config.data_shuffle_buffer,
+                seed=config.data_seed,
+                batch_buffers=max(config.data_batch_buffers,
+                                  config.data_prefetch + 3),
+                num_parts=config.num_workers,
+                part_index=part_index,
+                occluder_dir=config.data_occluders,
+                occlusion_prob=config.data_occlusion_prob,
+                occ_thresholds=config.data_occ_thresholds,
+                occ_proportions=config.data_occ_proportions,
+                identity_images=config.data_identity_images,
+                identity_weights=config.data_identity_weights,
+                compress_threads=config.data_compress_threads,
+                compress_cache=config.data_compress_cache,
+            )
+
+        if config.data_sources:
+            from image_iter import FaceMixIter
+            from sampler import mix_batch_sizes
+            shares = mix_batch_sizes(args.per_batch_size,
+                                     [w for _, w in config.data_sources])
+            iter_list = []
+            label_offsets = []
+            offset = 0
+            for (name, _), share in zip(config.data_sources, shares):
+                assert dataset[name].image_shape == config.image_shape
+                if share > 0:
+                    print('data source', name, share, 'per device')
+                    iter_list.append(
+                        make_dataiter(
+                            os.path.join(dataset[name].dataset_path,
+                                         'train.rec'),
+                            share * args.ctx_num))
+                    label_offsets.append(offset)
+                offset += dataset[name].num_classes
+            train_dataiter = FaceMixIter(iter_list,
+                                         label_offsets,
+                                         ctx_num=args.ctx_num,
+                                         depth=max(config.data_prefetch, 1))
+        elif config.data_shards:
+            # sequential tar shards, see common/rec2shards.py
+            from shard_image_iter import FaceShardIter
+            train_dataiter = FaceShardIter(
+                batch_size=args.batch_size,
+                data_shape=data_shape,
+                path_shards=config.data_shards,
+                shuffle=True,
+                rand_mirror=config.data_rand_mirror,
+                mean=mean,
+                cutoff=config.data_cutoff,
+                color_jittering=config.data_color,
+                num_readers=config.data_shard_readers,
+                shuffle_buffer=config.data_shuffle_buffer,
+                seed=config.data_seed,
+                batch_buffers=max(config.data_batch_buffers,
+                                  config.data_prefetch + 3),
+                num_parts=config.num_workers,
+                part_index=part_index,
+                occluder_dir=config.data_occluders,
+                occlusion_prob=config.data_occlusion_prob,
+            )
+        else:
+            train_dataiter = make_dataiter(path_imgrec, args.batch_size,
+                                           path_imglist)
         metric1 = AccMetric()
         eval_metrics = [mx.metric.create(metric1)]
         if config.ce_loss:
@@ -442,6 +536,17 @@ def train_net(args):
                 break
 
         _cb(param)
+        if mbatch % args.frequent == 0:
+            if train_dataiter is not base_dataiter:
+                qs = train_dataiter.stats()
+                print('data queue: occupancy %.1f/%d, starved %d/%d, waited %.3fs' %
+                      (qs['mean_occupancy'], qs['depth'], qs['starved'],
+                       qs['batches'], qs['wait_time']))
+            if hasattr(base_dataiter, 'sources'):
+                for i, qs in enumerate(base_dataiter.stats()):
+                    print('source %d queue: occupancy %.1f/%d, starved %d/%d, waited %.3fs' %
+                          (i, qs['mean_occupancy'], qs['depth'], qs['starved'],
+                           qs['batches'], qs['wait_time']))
         if mbatch % 1000 == 0:
             print('lr-batch-epoch:', opt.lr, param.nbatch, param.epoch)
 
@@ -491,12 +596,36 @@ def train_net(args):
                 else:
                     mx.model.save_checkpoint(prefix, msave, model.symbol, arg,
                                              aux)
+                # data order and augmentation position, for resuming
+                with open('%s-%04d.state' % (prefix, msave), 'w') as f:
+                    json.dump(
+                        {
+                            'data_iter':
+                            base_dataiter.get_state(param.nbatch + 1),
+                            'global_step': mbatch,
+                        }, f)
             print('[%d]Accuracy-Highest: %1.5f' % (mbatch, highest_acc[-1]))
         if config.max_steps > 0 and mbatch > config.max_steps:
             sys.exit(0)
 
     epoch_cb = None
-    train_dataiter = mx.io.PrefetchingIter(train_dataiter)
+    base_dataiter = train_dataiter
+    if len(args.pretrained) > 0:
+        state_path = '%s-%04d.state' % (args.pretrained, args.pretrained_epoch)
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            print('resuming data iterator from', state_path, state)
+            base_dataiter.set_state(state['data_iter'])
+            global_step[0] = state['global_step']
+            for step in lr_steps:
+                if global_step[0] >= step:
+                    opt.lr *= 0.1
+            print('lr', opt.lr, 'global_step', global_step[0])
+    if config.data_prefetch > 0:
+        from image_iter import FacePrefetchIter
+        train_dataiter = FacePrefetchIter(train_dataiter,
+                                          depth=config.data_prefetch)
 
     model.fit(
         train_dataiter,
@@ -504,7 +633,7 @@ def train_net(args):
         num_epoch=999999,
         eval_data=val_dataiter,
         eval_metric=eval_metrics,
-        kvstore=args.kvstore,
+        kvstore=kv,
         optimizer=opt,
         #optimizer_params   = optimizer_params,
         initializer=initializer,
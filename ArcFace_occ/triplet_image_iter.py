@@ -0,0 +1,239 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import numpy as np
+
+import mxnet as mx
+from mxnet import ndarray as nd
+from mxnet import io
+
+import image_iter
+
+logger = logging.getLogger()
+
+
+class FaceImageIter(image_iter.FaceImageIter):
+    """Triplet iterator with online semi-hard mining.
+
+    Identities are visited in a random order, in bags of
+    `triplet_bag_size // images_per_identity` identities. Each bag is
+    embedded in full batches with a copy of the training model's current
+    parameters, and semi-hard triplets are picked from its distance matrix.
+    Every per-context slice of a batch is laid out as
+    [anchors; positives; negatives], as expected by the triplet losses in
+    train.py.
+    """
+    def __init__(self,
+                 batch_size,
+                 data_shape,
+                 path_imgrec=None,
+                 shuffle=False,
+                 aug_list=None,
+                 mean=None,
+                 rand_mirror=False,
+                 cutoff=0,
+                 ctx_num=1,
+                 images_per_identity=5,
+                 triplet_params=None,
+                 triplet_metric='euclidean',
+                 mx_model=None,
+                 data_name='data',
+                 label_name='softmax_label',
+                 **kwargs):
+        super(FaceImageIter, self).__init__(batch_size,
+                                            data_shape,
+                                            path_imgrec=path_imgrec,
+                                            shuffle=shuffle,
+                                            aug_list=aug_list,
+                                            mean=mean,
+                                            rand_mirror=rand_mirror,
+                                            cutoff=cutoff,
+                                            data_name=data_name,
+                                            label_name=label_name,
+                                            **kwargs)
+        assert hasattr(self, 'id2range'), 'triplet training needs an identity indexed rec'
+        assert triplet_params is not None
+        assert batch_size % ctx_num == 0
+        self.ctx_num = ctx_num
+        self.per_batch_size = batch_size // ctx_num
+        assert self.per_batch_size % 3 == 0
+        self.images_per_identity = images_per_identity
+        self.triplet_bag_size = triplet_params[0]
+        self.triplet_alpha = triplet_params[1]
+        self.triplet_max_ap = triplet_params[2]
+        assert triplet_metric in ('euclidean', 'angular')
+        self.triplet_metric = triplet_metric
+        self.bag_identities = max(
+            self.triplet_bag_size // self.images_per_identity, 2)
+        self.mx_model = mx_model
+        self.embed_model = None
+        self.triplets = np.zeros((0, 3), dtype=np.int64)
+        self.triplet_cur = 0
+        self.triplet_batches = 0
+        self.bag_start = 0
+        self.bag_batches = 0
+        print('triplet bag identities', self.bag_identities)
+
+    def build_seq(self):
+        """The epoch order is an order of identities; images are drawn
+        per bag."""
+        rng = np.random.RandomState([self.seed, self.epoch])
+        self.seq = np.array(sorted(self.id2range), dtype=np.int64)
+        if self.shuffle:
+            rng.shuffle(self.seq)
+        self.triplets = np.zeros((0, 3), dtype=np.int64)
+        self.triplet_cur = 0
+        self.triplet_batches = 0
+        self.bag_start = 0
+        self.bag_batches = 0
+
+    def get_state(self, num_batches=None):
+        """Mining depends on the model, so a resumed run mines the current
+        bag again: the state is the bag's position in the identity order
+        and the batch count at which it was mined, which keeps the
+        augmentation seeds going. `num_batches` is ignored."""
+        return {
+            'seed': self.seed,
+            'epoch': max(self.epoch, 0),
+            'bag_start': self.bag_start,
+            'triplet_batches': self.bag_batches,
+        }
+
+    def set_state(self, state):
+        super(FaceImageIter, self).set_state({
+            'seed': state['seed'],
+            'epoch': state['epoch'],
+            'cur': 0,
+        })
+        self.cur = self.bag_start = state['bag_start']
+        self.triplet_batches = self.bag_batches = state['triplet_batches']
+        self.epoch_batches = self.resume_batches = self.triplet_batches
+
+    def next_indices(self):
+        """Record keys of the next triplet batch, mining a new bag when
+        the current one is used up."""
+        num_triplets = self.batch_size // 3
+        while len(self.triplets) - self.triplet_cur < num_triplets:
+            self.mine_bag()
+        triplets = self.triplets[self.triplet_cur:self.triplet_cur +
+                                 num_triplets]
+        self.triplet_cur += num_triplets
+        per = self.per_batch_size // 3
+        keys = []
+        for k in range(self.ctx_num):
+            t = triplets[k * per:(k + 1) * per]
+            keys += [t[:, 0], t[:, 1], t[:, 2]]
+        seed = [self.seed, self.epoch, self.triplet_batches]
+        self.triplet_batches += 1
+        return np.concatenate(keys), seed
+
+    def mine_bag(self):
+        if self.cur >= len(self.seq):
+            raise StopIteration
+        self.bag_start = self.cur
+        self.bag_batches = self.triplet_batches
+        identities = self.seq[self.cur:self.cur + self.bag_identities]
+        self.cur += len(identities)
+        rng = np.random.RandomState([self.seed, self.epoch, self.bag_start])
+        keys = []
+        groups = []
+        for identity in identities.tolist():
+            a, b = self.id2range[identity]
+            if b - a < 2:
+                continue
+            n = min(b - a, self.images_per_identity)
+            keys.append(a + rng.choice(b - a, n, replace=False))
+            groups.append(np.full((n, ), identity, dtype=np.int64))
+        if len(keys) < 2:
+            return
+        keys = np.concatenate(keys)
+        groups = np.concatenate(groups)
+        emb = self.embed(keys, rng)
+        triplets = self.pick_triplets(emb, groups, rng)
+        rng.shuffle(triplets)
+        triplets = keys[triplets]
+        logging.info('triplet bag %d: %d images, %d triplets',
+                     self.bag_start, len(keys), len(triplets))
+        self.triplets = np.concatenate(
+            [self.triplets[self.triplet_cur:], triplets])
+        self.triplet_cur = 0
+
+    def embed(self, keys, rng):
+        """L2-normalized embeddings of `keys` with the current training
+        parameters, or None while the model is not initialized yet."""
+        if self.mx_model is None or not self.mx_model.params_initialized:
+            return None
+        if self.embed_model is None:
+            sym = self.mx_model.symbol.get_internals()['fc1_output']
+            self.embed_model = mx.mod.Module(
+                symbol=sym,
+                context=self.mx_model._context[0],
+                label_names=None)
+            self.embed_model.bind(data_shapes=[
+                ('data', (self.batch_size, ) + self.data_shape)
+            ],
+                                  for_training=False)
+        arg, aux = self.mx_model.get_params()
+        self.embed_model.set_params(arg, aux, allow_extra=True)
+        emb = None
+        for begin in range(0, len(keys), self.batch_size):
+            chunk = keys[begin:begin + self.batch_size]
+            count = len(chunk)
+            if count < self.batch_size:
+                chunk = np.resize(chunk, (self.batch_size, ))
+            data, _, _ = self.load_batch(chunk, rng.randint(0, 2**31 - 1))
+            self.embed_model.forward(io.DataBatch([nd.array(data)]),
+                                     is_train=False)
+            out = self.embed_model.get_outputs()[0].asnumpy()
+            if emb is None:
+                emb = np.empty((len(keys), out.shape[1]), dtype=np.float32)
+            emb[begin:begin + count] = out[:count]
+        emb /= np.maximum(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12)
+        return emb
+
+    def pick_triplets(self, emb, groups, rng, chunk=1024):
+        """Picks one semi-hard negative for every (anchor, positive) pair.
+
+        `emb` is (M,D) normalized, `groups` the (M,) identity of each row,
+        with rows of an identity contiguous. A negative n is valid for
+        (a, p) when d(a,p) < d(a,n) < d(a,p) + alpha; one is drawn at
+        random among the valid ones. Returns (T,3) row indices. Without
+        embeddings the negatives are drawn uniformly.
+        """
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        ends = np.r_[starts[1:], len(groups)]
+        anchors = []
+        positives = []
+        for s, e in zip(starts.tolist(), ends.tolist()):
+            a, p = np.triu_indices(e - s, 1)
+            anchors.append(a + s)
+            positives.append(p + s)
+        anchors = np.concatenate(anchors)
+        positives = np.concatenate(positives)
+        m = len(groups)
+        if emb is None:
+            neg = rng.randint(0, m, size=len(anchors))
+            ok = groups[neg] != groups[anchors]
+            return np.stack([anchors[ok], positives[ok], neg[ok]], axis=1)
+        sim = np.dot(emb, emb.T)
+        if self.triplet_metric == 'angular':
+            dist = np.arccos(np.clip(sim, -1.0, 1.0))
+        else:
+            dist = np.maximum(2.0 - 2.0 * sim, 0.0)
+        triplets = []
+        for begin in range(0, len(anchors), chunk):
+            a = anchors[begin:begin + chunk]
+            p = positives[begin:begin + chunk]
+            ap = dist[a, p][:, np.newaxis]
+            an = dist[a]
+            valid = (an > ap) & (an - ap < self.triplet_alpha)
+            valid &= groups[np.newaxis, :] != groups[a][:, np.newaxis]
+            if self.triplet_max_ap > 0.0:
+                valid &= ap <= self.triplet_max_ap
+            score = np.where(valid, rng.uniform(size=valid.shape), -1.0)
+            neg = score.argmax(axis=1)
+            ok = score[np.arange(len(a)), neg] >= 0.0
+            triplets.append(np.stack([a[ok], p[ok], neg[ok]], axis=1))
+        return np.concatenate(triplets)
@@ -14,12 +14,12 @@ def parse_lst_line(line):
   #print(vec)
   if len(vec)>3:
     bbox = np.zeros( (4,), dtype=np.int32)
-    for i in xrange(3,7):
+    for i in range(3,7):
       bbox[i-3] = int(vec[i])
     landmark = None
     if len(vec)>7:
       _l = []
-      for i in xrange(7,17):
+      for i in range(7,17):
         _l.append(float(vec[i]))
       landmark = np.array(_l).reshape( (2,5) ).T
   #print(aligned)
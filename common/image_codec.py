@@ -0,0 +1,67 @@
+"""Image payload codecs of rec records.
+
+Records hold JPEG by default (RecBuilder, quality 95), but any format that
+decode() recognizes can be stored: PNG, WebP, or raw BGR pixels. Raw
+payloads are `RAW_MAGIC`, then height and width as little-endian uint16,
+then the HxWx3 uint8 BGR pixels, so decoding is a copy.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import struct
+import numpy as np
+import cv2
+
+RAW_MAGIC = b'RAW3'
+_RAW_HEADER = '<4sHH'
+_RAW_HEADER_SIZE = struct.calcsize(_RAW_HEADER)
+
+FORMATS = ('jpg', 'png', 'webp', 'raw')
+
+
+def encode(img, fmt='jpg', quality=95):
+    """Encodes a BGR uint8 image. `quality` is the JPEG/WebP quality
+    (1-100) or the PNG compression level (0-9)."""
+    if fmt == 'raw':
+        h, w = img.shape[:2]
+        return struct.pack(_RAW_HEADER, RAW_MAGIC, h, w) + \
+            np.ascontiguousarray(img, dtype=np.uint8).tobytes()
+    if fmt == 'jpg':
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif fmt == 'png':
+        params = [cv2.IMWRITE_PNG_COMPRESSION, quality]
+    elif fmt == 'webp':
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    else:
+        raise ValueError('unknown image format %s' % fmt)
+    ret, buf = cv2.imencode('.' + fmt, img, params)
+    assert ret, 'failed to encode %s' % fmt
+    return buf.tobytes()
+
+
+def decode(s):
+    """Decodes a payload to a BGR uint8 image, None if it is invalid."""
+    if bytes(s[:4]) == RAW_MAGIC:
+        _, h, w = struct.unpack_from(_RAW_HEADER, s)
+        if len(s) != _RAW_HEADER_SIZE + h * w * 3:
+            return None
+        return np.frombuffer(s, dtype=np.uint8,
+                             offset=_RAW_HEADER_SIZE).reshape((h, w, 3))
+    return cv2.imdecode(np.frombuffer(s, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def image_format(s):
+    """Sniffs the format of a payload from its first bytes."""
+    head = bytes(s[:12])
+    if head[:4] == RAW_MAGIC:
+        return 'raw'
+    if head[:4] == b'\x89PNG':
+        return 'png'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return 'jpg'
+
+
+def image_ext(s):
+    return '.' + image_format(s)
@@ -0,0 +1,104 @@
+"""Bit-packed occlusion mask sidecar.
+
+A `train.mask` file sits next to `train.rec`/`train.idx` and stores one
+fixed-size row per record index, so the mask of record `idx` lives at
+`HEADER_SIZE + idx * row_bytes`. Each row is the HxW binary mask packed to
+bits (1568 bytes for 112x112, instead of 50176 bytes of float32 labels in
+the IRHeader). Records without a mask read back as all zeros.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import struct
+import numpy as np
+
+MAGIC = b'OCCM'
+VERSION = 1
+_HEADER_FORMAT = '<4sIII'
+HEADER_SIZE = struct.calcsize(_HEADER_FORMAT)
+
+
+def mask_path(path_imgrec):
+    """Sidecar path for a `.rec` file."""
+    return os.path.splitext(path_imgrec)[0] + '.mask'
+
+
+def row_bytes(image_size):
+    return (image_size[0] * image_size[1] + 7) // 8
+
+
+def pack_mask(mask, image_size):
+    """Packs a HxW (or 1xHxW / flat) mask, binarized at 0.5, into bytes."""
+    mask = np.asarray(mask).reshape(image_size[0] * image_size[1])
+    return np.packbits(mask > 0.5).tobytes()
+
+
+def unpack_masks(rows, image_size):
+    """Unpacks (N, row_bytes) uint8 rows into float32 (N,1,H,W) masks."""
+    h, w = image_size
+    bits = np.unpackbits(rows, axis=1)[:, :h * w]
+    return bits.reshape((-1, 1, h, w)).astype(np.float32)
+
+
+class MaskWriter():
+    def __init__(self, path, image_size=(112, 112), append=False):
+        self.path = path
+        self.image_size = image_size
+        self.row_bytes = row_bytes(image_size)
+        if append and os.path.exists(path):
+            # keep the existing rows, new rows may extend the file
+            self.f = open(path, 'r+b')
+            magic, _, h, w = struct.unpack(_HEADER_FORMAT,
+                                           self.f.read(HEADER_SIZE))
+            assert magic == MAGIC, 'not a mask sidecar: %s' % path
+            assert (h, w) == tuple(image_size), \
+                'mask size %dx%d of %s' % (h, w, path)
+            return
+        self.f = open(path, 'wb')
+        self.f.write(
+            struct.pack(_HEADER_FORMAT, MAGIC, VERSION, image_size[0],
+                        image_size[1]))
+
+    def write(self, idx, mask):
+        self.f.seek(HEADER_SIZE + idx * self.row_bytes)
+        self.f.write(pack_mask(mask, self.image_size))
+
+    def close(self):
+        self.f.close()
+
+
+class MaskReader():
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            magic, version, h, w = struct.unpack(_HEADER_FORMAT,
+                                                 f.read(HEADER_SIZE))
+        assert magic == MAGIC, 'not a mask sidecar: %s' % path
+        self.path = path
+        self.image_size = (h, w)
+        self.row_bytes = row_bytes(self.image_size)
+        num_rows = (os.path.getsize(path) - HEADER_SIZE) // self.row_bytes
+        self.rows = np.memmap(path,
+                              dtype=np.uint8,
+                              mode='r',
+                              offset=HEADER_SIZE,
+                              shape=(num_rows, self.row_bytes))
+
+    def __len__(self):
+        return self.rows.shape[0]
+
+    def read(self, idx):
+        return self.read_batch([idx])[0]
+
+    def read_rows(self, indices):
+        """Returns the packed (N, row_bytes) rows of record `indices`."""
+        indices = np.asarray(indices, dtype=np.int64)
+        rows = np.zeros((len(indices), self.row_bytes), dtype=np.uint8)
+        ok = indices < len(self)
+        rows[ok] = self.rows[indices[ok]]
+        return rows
+
+    def read_batch(self, indices):
+        """Returns the float32 (N,1,H,W) masks of record `indices`."""
+        return unpack_masks(self.read_rows(indices), self.image_size)
@@ -0,0 +1,174 @@
+"""Pre-decoded training store.
+
+Decodes every image record of a rec file once into parallel .npy arrays
+next to it, all opened with memory mapping:
+
+    <name>_images.npy  uint8 (N,H,W,3) RGB
+    <name>_labels.npy  float32 (N,)
+    <name>_keys.npy    int64 (N,) record key of each row
+    <name>_masks.npy   uint8 (N,row_bytes) bit-packed masks, see mask_pack
+    <name>_valid.npy   bool (N,) False for undecodable records, whose rows
+                       are left blank; stores without it are all valid
+
+Usage: python memmap_store.py --input /path/to/train.rec --workers 16
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import numbers
+import logging
+import argparse
+import multiprocessing
+import numpy as np
+import cv2
+import mxnet as mx
+import mask_pack
+from rec_index import build_index
+from mmap_recordio import MmapIndexedRecordIO
+import image_codec
+
+SUFFIXES = ('images', 'labels', 'keys', 'masks')
+OPTIONAL_SUFFIXES = ('valid', )
+
+
+def store_paths(path_imgrec):
+    stem = os.path.splitext(path_imgrec)[0]
+    return dict((k, '%s_%s.npy' % (stem, k))
+                for k in SUFFIXES + OPTIONAL_SUFFIXES)
+
+
+def has_store(path_imgrec):
+    paths = store_paths(path_imgrec)
+    return all(os.path.exists(paths[k]) for k in SUFFIXES)
+
+
+class MemmapStore():
+    def __init__(self, path_imgrec):
+        paths = store_paths(path_imgrec)
+        self.images = np.load(paths['images'], mmap_mode='r')
+        self.labels = np.load(paths['labels'], mmap_mode='r')
+        self.masks = np.load(paths['masks'], mmap_mode='r')
+        keys = np.load(paths['keys'])
+        self.valid = None
+        if os.path.exists(paths['valid']):
+            self.valid = np.load(paths['valid'])
+        self.image_size = self.images.shape[1:3]
+        self.row_of_key = np.full((int(keys.max()) + 1, ), -1, dtype=np.int64)
+        self.row_of_key[keys] = np.arange(len(keys))
+
+    def __len__(self):
+        return self.images.shape[0]
+
+    def rows(self, keys):
+        rows = self.row_of_key[np.asarray(keys, dtype=np.int64)]
+        assert (rows >= 0).all(), 'record not in memmap store'
+        return rows
+
+    def read_batch(self, keys, imgs, labels, masks):
+        """Fills uint8 (N,H,W,3) `imgs`, (N,) `labels` and float32
+        (N,1,H,W) `masks` for record `keys`. Returns the (N,) bool array of
+        rows that hold a valid image."""
+        rows = self.rows(keys)
+        # gather in file order so the page cache reads mostly forward
+        order = np.argsort(rows)
+        sorted_rows = rows[order]
+        imgs[order] = self.images[sorted_rows]
+        labels[order] = self.labels[sorted_rows]
+        masks[order] = mask_pack.unpack_masks(self.masks[sorted_rows],
+                                              self.image_size)
+        if self.valid is None:
+            return np.ones((len(rows), ), dtype=bool)
+        return self.valid[rows]
+
+
+def _convert_range(task):
+    path_imgrec, image_size, begin, end = task
+    mask_len = image_size[0] * image_size[1]
+    paths = store_paths(path_imgrec)
+    imgrec = MmapIndexedRecordIO(
+        os.path.splitext(path_imgrec)[0] + '.idx', path_imgrec)
+    keys = np.load(paths['keys'], mmap_mode='r')
+    images = np.load(paths['images'], mmap_mode='r+')
+    labels = np.load(paths['labels'], mmap_mode='r+')
+    masks = np.load(paths['masks'], mmap_mode='r+')
+    maskrec = None
+    if os.path.exists(mask_pack.mask_path(path_imgrec)):
+        maskrec = mask_pack.MaskReader(mask_pack.mask_path(path_imgrec))
+        masks[begin:end] = maskrec.read_rows(keys[begin:end])
+    invalid = []
+    for row in range(begin, end):
+        s = imgrec.read_idx(int(keys[row]))
+        header, s = mx.recordio.unpack(s)
+        img = image_codec.decode(s)
+        if img is None:
+            # the row keeps the zeros it was created with
+            logging.warning('invalid image, left blank: key %d', keys[row])
+            masks[row] = 0
+            invalid.append(row)
+            continue
+        if img.shape[0] != image_size[0] or img.shape[1] != image_size[1]:
+            img = cv2.resize(img, (image_size[1], image_size[0]))
+        images[row] = img[:, :, ::-1]
+        label = header.label
+        if isinstance(label, numbers.Number):
+            labels[row] = label
+        else:
+            labels[row] = label[0]
+            if maskrec is None and len(label) >= 2 + mask_len:
+                masks[row] = np.frombuffer(
+                    mask_pack.pack_mask(label[2:2 + mask_len], image_size),
+                    dtype=np.uint8)
+    images.flush()
+    labels.flush()
+    masks.flush()
+    return end - begin, invalid
+
+
+def main(args):
+    path_imgrec = args.input
+    image_size = [int(x) for x in args.image_size.split(',')]
+    imgrec = MmapIndexedRecordIO(
+        os.path.splitext(path_imgrec)[0] + '.idx', path_imgrec)
+    header, _ = mx.recordio.unpack(imgrec.read_idx(0))
+    if header.flag > 0:
+        _, _, keys = build_index(imgrec)
+    else:
+        keys = np.array(sorted(imgrec.keys), dtype=np.int64)
+    imgrec.close()
+    n = len(keys)
+    print('converting %d images' % n)
+    paths = store_paths(path_imgrec)
+    np.save(paths['keys'], keys)
+    open_memmap = np.lib.format.open_memmap
+    open_memmap(paths['images'], mode='w+', dtype=np.uint8,
+                shape=(n, image_size[0], image_size[1], 3)).flush()
+    open_memmap(paths['labels'], mode='w+', dtype=np.float32,
+                shape=(n, )).flush()
+    open_memmap(paths['masks'], mode='w+', dtype=np.uint8,
+                shape=(n, mask_pack.row_bytes(image_size))).flush()
+    tasks = [(path_imgrec, image_size, a, min(a + args.chunk, n))
+             for a in range(0, n, args.chunk)]
+    pool = multiprocessing.Pool(args.workers)
+    done = 0
+    valid = np.ones((n, ), dtype=bool)
+    for count, invalid in pool.imap_unordered(_convert_range, tasks):
+        done += count
+        valid[invalid] = False
+        print('converted', done, n)
+    pool.close()
+    pool.join()
+    np.save(paths['valid'], valid)
+    if not valid.all():
+        print('%d invalid images' % (n - valid.sum()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build a pre-decoded memmap training store')
+    # general
+    parser.add_argument('--input', default='', type=str, help='path to train.rec')
+    parser.add_argument('--image-size', default='112,112', type=str, help='')
+    parser.add_argument('--workers', default=8, type=int, help='decode processes')
+    parser.add_argument('--chunk', default=4096, type=int, help='records per task')
+    args = parser.parse_args()
+    main(args)
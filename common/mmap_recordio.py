@@ -0,0 +1,171 @@
+"""Memory-mapped, fork-safe reader for indexed RecordIO files.
+
+mx.recordio.MXIndexedRecordIO keeps one file handle with a seek position,
+which must not be shared between threads or forked processes, and pays a
+seek and a read syscall per record. MmapIndexedRecordIO maps the .rec file
+read-only and loads the .idx into a NumPy offset array; read_idx returns a
+zero-copy memoryview of the record, which mx.recordio.unpack,
+np.frombuffer and cv2.imdecode all accept. Any number of threads and
+forked workers can read from one instance concurrently.
+
+IndexedRecordIOWriter is the matching pure-Python writer. Unlike
+MXIndexedRecordIO(idx, rec, 'w') it can append to an existing rec/idx
+pair.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import mmap
+import collections
+import struct
+import numpy as np
+
+# dmlc RecordIO framing: magic, then cflag (3 bits) and length (29 bits)
+MAGIC = 0xced7230a
+_MAGIC_BYTES = struct.pack('<I', MAGIC)
+_LENGTH_MASK = (1 << 29) - 1
+
+
+def load_idx(path_imgidx):
+    """Returns (keys, offsets) int64 arrays from a `key\\toffset` .idx."""
+    with open(path_imgidx, 'rb') as f:
+        data = f.read()
+    table = np.array(data.split(), dtype=np.int64).reshape((-1, 2))
+    return table[:, 0], table[:, 1]
+
+
+class MmapIndexedRecordIO(object):
+    """Read-only drop-in for mx.recordio.MXIndexedRecordIO(idx, rec, 'r')."""
+    def __init__(self, idx_path, uri):
+        self.idx_path = idx_path
+        self.uri = uri
+        self.open()
+
+    def open(self):
+        keys, offsets = load_idx(self.idx_path)
+        self.keys = keys.tolist()
+        # dense key -> offset lookup, -1 for missing keys
+        self.offsets = np.full((int(keys.max()) + 1 if len(keys) else 0, ),
+                               -1,
+                               dtype=np.int64)
+        self.offsets[keys] = offsets
+        with open(self.uri, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+
+    def close(self):
+        self.view.release()
+        try:
+            self.mm.close()
+        except BufferError:
+            # records handed out still point into the map; it is unmapped
+            # once they are gone
+            pass
+
+    def __getstate__(self):
+        # the map is reopened on unpickling, e.g. in spawned processes
+        return {'idx_path': self.idx_path, 'uri': self.uri}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def read_idx(self, idx):
+        """Returns the record with key `idx` as a memoryview."""
+        if idx >= len(self.offsets) or self.offsets[idx] < 0:
+            raise KeyError(idx)
+        return self.read_at(int(self.offsets[idx]))
+
+    def read_at(self, pos):
+        magic, lrec = struct.unpack_from('<II', self.mm, pos)
+        assert magic == MAGIC, 'invalid record at offset %d' % pos
+        cflag, length = lrec >> 29, lrec & _LENGTH_MASK
+        if cflag == 0:
+            return self.view[pos + 8:pos + 8 + length]
+        # the writer split the record at embedded magic numbers: parts are
+        # flagged 1 (first), 2 (middle) and 3 (last), with the magic
+        # number between them. Only these rare records are copied.
+        parts = []
+        while True:
+            parts.append(self.view[pos + 8:pos + 8 + length])
+            if cflag == 3:
+                break
+            parts.append(_MAGIC_BYTES)
+            pos += 8 + ((length + 3) & ~3)
+            magic, lrec = struct.unpack_from('<II', self.mm, pos)
+            assert magic == MAGIC, 'invalid record at offset %d' % pos
+            cflag, length = lrec >> 29, lrec & _LENGTH_MASK
+        return b''.join(parts)
+
+
+def write_record(f, buf):
+    """Writes one record in dmlc framing and returns the bytes written.
+
+    Like the dmlc writer, the record is split wherever the magic number
+    occurs at a 4-byte aligned position, so that readers can always
+    resynchronize on it.
+    """
+    buf = bytes(buf)
+    size = len(buf)
+    written = 0
+    begin = 0
+    pos = buf.find(_MAGIC_BYTES)
+    while 0 <= pos < (size >> 2) << 2:
+        if pos % 4 == 0:
+            f.write(_MAGIC_BYTES)
+            f.write(struct.pack('<I', (1 if begin == 0 else 2) << 29 |
+                                (pos - begin)))
+            f.write(buf[begin:pos])
+            written += 8 + pos - begin
+            begin = pos + 4
+        pos = buf.find(_MAGIC_BYTES, pos + 1)
+    f.write(_MAGIC_BYTES)
+    f.write(struct.pack('<I', (3 if begin > 0 else 0) << 29 | (size - begin)))
+    f.write(buf[begin:])
+    padding = -size % 4
+    f.write(b'\0' * padding)
+    return written + 8 + size - begin + padding
+
+
+class IndexedRecordIOWriter(object):
+    """Write-only counterpart of MmapIndexedRecordIO.
+
+    With `append`, records are added after the end of an existing rec and
+    may reuse existing keys, which then point to the new record. The .idx
+    is only rewritten, atomically, by close(): until then the old index
+    stays valid and the appended bytes are simply unreferenced.
+    """
+    def __init__(self, idx_path, uri, append=False):
+        self.idx_path = idx_path
+        self.uri = uri
+        self.index = collections.OrderedDict()
+        if append:
+            keys, offsets = load_idx(idx_path)
+            self.index.update(zip(keys.tolist(), offsets.tolist()))
+            self.f = open(uri, 'ab')
+        else:
+            self.f = open(uri, 'wb')
+        self.pos = self.f.tell()
+
+    def __len__(self):
+        return len(self.index)
+
+    def write_idx(self, idx, buf):
+        self.index[int(idx)] = self.pos
+        self.pos += write_record(self.f, buf)
+
+    def close(self):
+        if self.f is None:
+            return
+        self.f.close()
+        self.f = None
+        tmp = self.idx_path + '.tmp'
+        with open(tmp, 'w') as f:
+            for key, offset in self.index.items():
+                f.write('%d\t%d\n' % (key, offset))
+        os.rename(tmp, self.idx_path)
@@ -0,0 +1,98 @@
+"""Per-record occlusion ratio sidecar.
+
+Scans every image record once and saves the fraction of occluded mask
+pixels as a float16 array indexed by record key, `<name>.occ.npy` next to
+the rec. Keys that are not image records hold -1. Masks are taken from the
+train.mask sidecar when there is one (no record is read then), otherwise
+from `header.label[2:]`.
+
+Usage: python occ_ratio.py --input /path/to/train.rec --workers 16
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import numbers
+import argparse
+import multiprocessing
+import numpy as np
+import mxnet as mx
+import mask_pack
+from rec_index import build_index
+from mmap_recordio import MmapIndexedRecordIO
+
+# number of set bits of every byte value
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis],
+                          axis=1).sum(axis=1)
+
+
+def occ_path(path_imgrec):
+    return os.path.splitext(path_imgrec)[0] + '.occ.npy'
+
+
+def load_ratios(path_imgrec):
+    """Returns the float32 per-key ratio array of a rec file."""
+    path = occ_path(path_imgrec)
+    if not os.path.exists(path):
+        raise ValueError('no occlusion ratios for %s, run common/occ_ratio.py'
+                         % path_imgrec)
+    return np.load(path).astype(np.float32)
+
+
+def _scan_keys(task):
+    path_imgrec, image_size, keys = task
+    mask_len = image_size[0] * image_size[1]
+    if os.path.exists(mask_pack.mask_path(path_imgrec)):
+        maskrec = mask_pack.MaskReader(mask_pack.mask_path(path_imgrec))
+        rows = maskrec.read_rows(keys)
+        return keys, _POPCOUNT[rows].sum(axis=1) / float(mask_len)
+    imgrec = MmapIndexedRecordIO(
+        os.path.splitext(path_imgrec)[0] + '.idx', path_imgrec)
+    ratios = np.zeros((len(keys), ), dtype=np.float32)
+    for i, key in enumerate(keys):
+        header, _ = mx.recordio.unpack(imgrec.read_idx(int(key)))
+        label = header.label
+        if not isinstance(label, numbers.Number) and len(label) >= 2 + mask_len:
+            ratios[i] = (np.asarray(label[2:2 + mask_len]) > 0.5).mean()
+    imgrec.close()
+    return keys, ratios
+
+
+def main(args):
+    path_imgrec = args.input
+    image_size = [int(x) for x in args.image_size.split(',')]
+    imgrec = MmapIndexedRecordIO(
+        os.path.splitext(path_imgrec)[0] + '.idx', path_imgrec)
+    header, _ = mx.recordio.unpack(imgrec.read_idx(0))
+    if header.flag > 0:
+        _, _, keys = build_index(imgrec)
+    else:
+        keys = np.array(sorted(imgrec.keys), dtype=np.int64)
+    num_keys = int(max(imgrec.keys)) + 1
+    imgrec.close()
+    print('scanning %d images' % len(keys))
+    ratios = np.full((num_keys, ), -1.0, dtype=np.float16)
+    tasks = [(path_imgrec, image_size, keys[a:a + args.chunk])
+             for a in range(0, len(keys), args.chunk)]
+    pool = multiprocessing.Pool(args.workers)
+    done = 0
+    for chunk, r in pool.imap_unordered(_scan_keys, tasks):
+        ratios[chunk] = r
+        done += len(chunk)
+        print('scanned', done, len(keys))
+    pool.close()
+    pool.join()
+    np.save(occ_path(path_imgrec), ratios)
+    r = ratios[keys].astype(np.float32)
+    print('clean %d, mean occlusion %.4f' % ((r == 0).sum(), r.mean()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='scan per-record occlusion ratios')
+    # general
+    parser.add_argument('--input', default='', type=str, help='path to train.rec')
+    parser.add_argument('--image-size', default='112,112', type=str, help='')
+    parser.add_argument('--workers', default=8, type=int, help='scan processes')
+    parser.add_argument('--chunk', default=4096, type=int, help='records per task')
+    args = parser.parse_args()
+    main(args)
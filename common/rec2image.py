@@ -1,60 +1,94 @@
+"""Exports identity-grouped rec files into one image folder per identity.
+
+Identities are split across a process pool. Every identity is written to
+a temporary directory that is renamed to `<dataset no>_<identity key>` once
+complete, so an interrupted export resumes where it stopped: finished
+identities are skipped and partial ones are redone. With --raw the stored
+image bytes are copied as is, named by their format (see image_codec),
+which is lossless and avoids the decode and re-encode; otherwise images
+are decoded and written as JPEG.
+
+Usage: python rec2image.py --include /path/to/ds1,/path/to/ds2 --output /path/to/images --workers 8 --raw
+"""
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 import os
-import sys
-import mxnet as mx
-from mxnet import ndarray as nd
-import random
+import shutil
 import argparse
+import multiprocessing
 import cv2
-import time
-import sklearn
-import numpy as np
+import mxnet as mx
+from mmap_recordio import MmapIndexedRecordIO
+from rec_index import build_index
+import image_codec
+
+
+def _export_identities(task):
+    path_imgrec, output, raw, ds_id, identities = task
+    imgrec = MmapIndexedRecordIO(
+        os.path.splitext(path_imgrec)[0] + '.idx', path_imgrec)
+    written = 0
+    for identity, a, b in identities:
+        id_dir = os.path.join(output, "%d_%d" % (ds_id, identity))
+        tmp = id_dir + '.tmp'
+        os.makedirs(tmp)
+        for imgid, _idx in enumerate(range(a, b)):
+            _header, _img = mx.recordio.unpack(imgrec.read_idx(_idx))
+            if raw:
+                with open(os.path.join(tmp, "%d%s" % (imgid, image_codec.image_ext(_img))),
+                          'wb') as f:
+                    f.write(_img)
+            else:
+                _img = image_codec.decode(_img)  # bgr
+                cv2.imwrite(os.path.join(tmp, "%d.jpg" % imgid), _img)
+        os.rename(tmp, id_dir)
+        written += 1
+    imgrec.close()
+    return ds_id, written
 
 
 def main(args):
     include_datasets = args.include.split(',')
-    rec_list = []
-    for ds in include_datasets:
-        path_imgrec = os.path.join(ds, 'train.rec')
-        path_imgidx = os.path.join(ds, 'train.idx')
-        imgrec = mx.recordio.MXIndexedRecordIO(path_imgidx, path_imgrec, 'r')  # pylint: disable=redefined-variable-type
-        rec_list.append(imgrec)
     if not os.path.exists(args.output):
         os.makedirs(args.output)
-    for ds_id in range(len(rec_list)):
-        id_list = []
-        imgrec = rec_list[ds_id]
-        s = imgrec.read_idx(0)
-        header, _ = mx.recordio.unpack(s)
-        assert header.flag > 0
-        print('header0 label', header.label)
-        header0 = (int(header.label[0]), int(header.label[1]))
-        seq_identity = range(int(header.label[0]), int(header.label[1]))
-        pp = 0
-        for identity in seq_identity:
-            id_dir = os.path.join(args.output, "%d_%d" % (ds_id, identity))
-            os.makedirs(id_dir)
-            pp += 1
-            if pp % 10 == 0:
-                print('processing id', pp)
-            s = imgrec.read_idx(identity)
-            header, _ = mx.recordio.unpack(s)
-            imgid = 0
-            for _idx in range(int(header.label[0]), int(header.label[1])):
-                s = imgrec.read_idx(_idx)
-                _header, _img = mx.recordio.unpack(s)
-                _img = mx.image.imdecode(_img).asnumpy()[:, :, ::-1]  # to bgr
-                image_path = os.path.join(id_dir, "%d.jpg" % imgid)
-                cv2.imwrite(image_path, _img)
-                imgid += 1
+    for name in os.listdir(args.output):
+        # partial identities of an interrupted export
+        if name.endswith('.tmp'):
+            shutil.rmtree(os.path.join(args.output, name))
+    tasks = []
+    for ds_id, ds in enumerate(include_datasets):
+        path_imgrec = os.path.join(ds, 'train.rec')
+        imgrec = MmapIndexedRecordIO(os.path.join(ds, 'train.idx'),
+                                     path_imgrec)
+        header0, identities, _ = build_index(imgrec)
+        imgrec.close()
+        print('header0 label', header0)
+        todo = [(int(identity), int(a), int(b))
+                for identity, a, b in identities
+                if not os.path.isdir(
+                    os.path.join(args.output, "%d_%d" % (ds_id, identity)))]
+        print('dataset %d: %d identities, %d to export' %
+              (ds_id, len(identities), len(todo)))
+        tasks += [(path_imgrec, args.output, args.raw, ds_id,
+                   todo[a:a + args.chunk])
+                  for a in range(0, len(todo), args.chunk)]
+    pool = multiprocessing.Pool(args.workers)
+    done = 0
+    for ds_id, written in pool.imap_unordered(_export_identities, tasks):
+        done += written
+        print('exported identities', done)
+    pool.close()
+    pool.join()
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='do dataset merge')
+    parser = argparse.ArgumentParser(description='export rec files into image folders')
     # general
     parser.add_argument('--include', default='/home/hbj/datasets/train_tmp/', type=str, help='')
     parser.add_argument('--output', default='/home/hbj/tmp/temp/', type=str, help='')
+    parser.add_argument('--workers', default=8, type=int, help='export processes')
+    parser.add_argument('--chunk', default=100, type=int, help='identities per task')
+    parser.add_argument('--raw', action='store_true', help='copy the stored image bytes without re-encoding')
     args = parser.parse_args()
     main(args)
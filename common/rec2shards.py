@@ -0,0 +1,135 @@
+"""Exports a rec file into fixed-size tar shards for sequential streaming.
+
+Every sample is stored as consecutive tar members named by its record key:
+
+    <key>.jpg   the encoded image, copied from the rec as is (.png, .webp or
+                .raw for other formats, see image_codec)
+    <key>.cls   the label, as text
+    <key>.mask  the bit-packed occlusion mask, see mask_pack (if any)
+
+`shards.json` next to the shards holds header0, the identity table
+(identity key, first image key, end image key), the image size and the
+sample count of every shard. Samples are shuffled across shards unless
+--no-shuffle is given. Read them back with ArcFace_occ/shard_image_iter.py.
+
+Usage: python rec2shards.py --input /path/to/train.rec --output /path/to/shards --workers 8
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import io
+import json
+import tarfile
+import numbers
+import argparse
+import multiprocessing
+import numpy as np
+import mxnet as mx
+import mask_pack
+from image_codec import image_ext
+from rec_index import build_index
+from mmap_recordio import MmapIndexedRecordIO
+
+MANIFEST = 'shards.json'
+
+
+def shard_name(shard_no):
+    return 'shard-%06d.tar' % shard_no
+
+
+def add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _write_shard(task):
+    path_imgrec, output, image_size, shard_no, keys = task
+    imgrec = MmapIndexedRecordIO(
+        os.path.splitext(path_imgrec)[0] + '.idx', path_imgrec)
+    maskrec = None
+    if os.path.exists(mask_pack.mask_path(path_imgrec)):
+        maskrec = mask_pack.MaskReader(mask_pack.mask_path(path_imgrec))
+    mask_len = image_size[0] * image_size[1]
+    path = os.path.join(output, shard_name(shard_no))
+    tmp = path + '.tmp'
+    with tarfile.open(tmp, 'w') as tar:
+        for key in keys:
+            header, s = mx.recordio.unpack(imgrec.read_idx(key))
+            label = header.label
+            mask = None
+            if maskrec is not None:
+                row = maskrec.read_rows([key])[0]
+                if row.any():
+                    mask = row.tobytes()
+            if isinstance(label, numbers.Number):
+                label = int(label)
+            else:
+                if maskrec is None and len(label) >= 2 + mask_len:
+                    mask = mask_pack.pack_mask(label[2:2 + mask_len],
+                                               image_size)
+                label = int(label[0])
+            stem = '%09d' % key
+            add_member(tar, stem + image_ext(s), s)
+            add_member(tar, stem + '.cls', ('%d' % label).encode())
+            if mask is not None:
+                add_member(tar, stem + '.mask', mask)
+    os.rename(tmp, path)
+    imgrec.close()
+    return shard_no, len(keys)
+
+
+def main(args):
+    path_imgrec = args.input
+    image_size = [int(x) for x in args.image_size.split(',')]
+    imgrec = MmapIndexedRecordIO(
+        os.path.splitext(path_imgrec)[0] + '.idx', path_imgrec)
+    header, _ = mx.recordio.unpack(imgrec.read_idx(0))
+    header0 = None
+    identities = np.zeros((0, 3), dtype=np.int64)
+    if header.flag > 0:
+        header0, identities, keys = build_index(imgrec)
+    else:
+        keys = np.array(sorted(imgrec.keys), dtype=np.int64)
+    imgrec.close()
+    if not args.no_shuffle:
+        np.random.RandomState(args.seed).shuffle(keys)
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    tasks = [(path_imgrec, args.output, image_size, i,
+              keys[a:a + args.shard_size].tolist())
+             for i, a in enumerate(range(0, len(keys), args.shard_size))]
+    print('writing %d images into %d shards' % (len(keys), len(tasks)))
+    counts = {}
+    pool = multiprocessing.Pool(args.workers)
+    for shard_no, count in pool.imap_unordered(_write_shard, tasks):
+        counts[shard_no] = count
+        print('written', shard_name(shard_no), count)
+    pool.close()
+    pool.join()
+    manifest = {
+        'image_size': image_size,
+        'header0': None if header0 is None else list(header0),
+        'identities': identities.tolist(),
+        'shards': [{
+            'name': shard_name(i),
+            'count': counts[i]
+        } for i in sorted(counts)],
+    }
+    with open(os.path.join(args.output, MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export a rec file into tar shards')
+    # general
+    parser.add_argument('--input', default='', type=str, help='path to train.rec')
+    parser.add_argument('--output', default='', type=str, help='shard directory')
+    parser.add_argument('--image-size', default='112,112', type=str, help='')
+    parser.add_argument('--shard-size', default=10000, type=int, help='images per shard')
+    parser.add_argument('--workers', default=8, type=int, help='shards written in parallel')
+    parser.add_argument('--seed', default=0, type=int, help='seed of the sample shuffle')
+    parser.add_argument('--no-shuffle', action='store_true', help='keep the rec order')
+    args = parser.parse_args()
+    main(args)
@@ -7,7 +7,29 @@ import argparse
 import cv2
 import time
 import sklearn
+import numbers
+import collections
+import multiprocessing
 import numpy as np
+from mask_pack import MaskWriter
+from rec_index import build_index
+from mmap_recordio import MmapIndexedRecordIO, IndexedRecordIOWriter
+
+
+def pack_record(header, img):
+    # BGR images are JPEG-encoded, anything else is stored as is
+    if isinstance(img, np.ndarray):
+        return mx.recordio.pack_img(header, img, quality=95, img_fmt='.jpg')
+    return mx.recordio.pack(header, img)
+
+
+def _pack_records(task):
+    # mx.recordio.IRHeader does not pickle, headers come as plain tuples
+    headers, imgs = task
+    return [
+        pack_record(mx.recordio.IRHeader(*header), img)
+        for header, img in zip(headers, imgs)
+    ]
 
 
 class SeqRecBuilder():
@@ -22,8 +44,16 @@ class SeqRecBuilder():
             os.path.join(path, 'train.idx'), os.path.join(path, 'train.rec'),
             'w')
         self.label_stat = [-1, -1]
+        self.mask_writer = None
+
+    def add_mask(self, idx, mask):
+        # occlusion masks go to the bit-packed train.mask sidecar, not the header
+        if self.mask_writer is None:
+            self.mask_writer = MaskWriter(os.path.join(self.path, 'train.mask'),
+                                          self.image_size)
+        self.mask_writer.write(idx, mask)
 
-    def add(self, label, img, is_image=True):
+    def add(self, label, img, is_image=True, mask=None):
         #img should be BGR
         #if self.sis:
         #    assert label>=self.last_label
@@ -35,6 +65,8 @@ class SeqRecBuilder():
         else:
             s = mx.recordio.pack(header, img)
         self.writer.write_idx(idx, s)
+        if mask is not None:
+            self.add_mask(idx, mask)
         if self.label_stat[0] < 0:
             self.label_stat = [label, label]
         else:
@@ -42,43 +74,97 @@ class SeqRecBuilder():
             self.label_stat[1] = max(self.label_stat[1], label)
 
     def close(self):
+        self.writer.close()
+        if self.mask_writer is not None:
+            self.mask_writer.close()
         with open(os.path.join(self.path, 'property'), 'w') as f:
             f.write("%d,%d,%d\n" % (self.label_stat[1] + 1, self.image_size[0],
                                     self.image_size[1]))
 
 
 class RecBuilder():
-    def __init__(self, path, image_size=(112, 112)):
+    """Writes an identity-grouped rec: image records from key 1, then one
+    record per identity holding its image key range, then header0 at key 0.
+
+    With `append`, an existing rec in `path` is extended in place: new
+    images are appended to the rec and take the keys of the old identity
+    records onward, and close() writes the extended identity table,
+    header0 and property after them. Only the .idx is rewritten, so the
+    cost is proportional to the new data. Labels of added identities must
+    be above the existing ones. Sidecars computed from the old rec
+    (occ_ratio.py, memmap_store.py) have to be rebuilt.
+    """
+    def __init__(self, path, image_size=(112, 112), append=False):
         self.path = path
         self.image_size = image_size
         self.last_label = -1
         self.widx = 1
         if not os.path.exists(path):
             os.makedirs(path)
-        self.writer = mx.recordio.MXIndexedRecordIO(
-            os.path.join(path, 'train.idx'), os.path.join(path, 'train.rec'),
-            'w')
         self.label_stat = [-1, -1]
         self.identities = []
+        self.mask_writer = None
+        self.header_masks = False
+        path_imgidx = os.path.join(path, 'train.idx')
+        path_imgrec = os.path.join(path, 'train.rec')
+        self.append = append and os.path.exists(path_imgidx)
+        if self.append:
+            self.load_identities(path_imgidx, path_imgrec)
+        self.writer = IndexedRecordIOWriter(path_imgidx, path_imgrec,
+                                            append=self.append)
+
+    def load_identities(self, path_imgidx, path_imgrec):
+        imgrec = MmapIndexedRecordIO(path_imgidx, path_imgrec)
+        header, _ = mx.recordio.unpack(imgrec.read_idx(0))
+        if header.flag == 0:
+            raise ValueError('%s has no identity table to append to' %
+                             path_imgrec)
+        header0, identities, _ = build_index(imgrec)
+        self.identities = [[int(a), int(b)] for _, a, b in identities]
+        self.widx = header0[0]
+        for _, a, b in identities:
+            if b == a:
+                continue
+            header, _ = mx.recordio.unpack(imgrec.read_idx(int(a)))
+            label = header.label
+            if not isinstance(label, numbers.Number):
+                # masks stored in the header follow the label
+                self.header_masks = len(label) > 2
+                label = label[0]
+            if self.label_stat[0] < 0:
+                self.label_stat = [int(label), int(label)]
+            self.label_stat[1] = int(label)
+        self.last_label = self.label_stat[1]
+        imgrec.close()
 
-    def add(self, label, imgs):
+    def add_mask(self, idx, mask):
+        # occlusion masks go to the bit-packed train.mask sidecar, not the header
+        if self.mask_writer is None:
+            path = os.path.join(self.path, 'train.mask')
+            if self.header_masks and not os.path.exists(path):
+                raise ValueError('%s keeps its masks in the record headers, '
+                                 'convert it with rec_pack_masks.py first' %
+                                 self.path)
+            self.mask_writer = MaskWriter(path,
+                                          self.image_size,
+                                          append=self.append)
+        self.mask_writer.write(idx, mask)
+
+    def add(self, label, imgs, masks=None):
         #img should be BGR
         assert label >= 0
         assert label > self.last_label
         assert len(imgs) > 0
+        assert masks is None or len(masks) == len(imgs)
         idflag = [self.widx, -1]
-        for img in imgs:
+        headers = []
+        for i, img in enumerate(imgs):
             idx = self.widx
             self.widx += 1
-            header = mx.recordio.IRHeader(0, label, idx, 0)
-            if isinstance(img, np.ndarray):
-                s = mx.recordio.pack_img(header,
-                                         img,
-                                         quality=95,
-                                         img_fmt='.jpg')
-            else:
-                s = mx.recordio.pack(header, img)
-            self.writer.write_idx(idx, s)
+            headers.append(mx.recordio.IRHeader(0, label, idx, 0))
+            if masks is not None and masks[i] is not None:
+                self.add_mask(idx, masks[i])
+        self.write_records(headers, imgs)
         idflag[1] = self.widx
         self.identities.append(idflag)
         if self.label_stat[0] < 0:
@@ -88,6 +174,10 @@ class RecBuilder():
             self.label_stat[1] = max(self.label_stat[1], label)
         self.last_label = label
 
+    def write_records(self, headers, imgs):
+        for header, img in zip(headers, imgs):
+            self.writer.write_idx(header.id, pack_record(header, img))
+
     def close(self):
         id_idx = self.widx
         for id_flag in self.identities:
@@ -102,8 +192,55 @@ class RecBuilder():
         _header = mx.recordio.IRHeader(0, (id_idx, self.widx), idx, 1)
         s = mx.recordio.pack(_header, b'')
         self.writer.write_idx(idx, s)
+        self.writer.close()
         print('label stat:', self.label_stat)
+        if self.mask_writer is not None:
+            self.mask_writer.close()
 
         with open(os.path.join(self.path, 'property'), 'w') as f:
             f.write("%d,%d,%d\n" % (self.label_stat[1] + 1, self.image_size[0],
                                     self.image_size[1]))
+
+
+class ParallelRecBuilder(RecBuilder):
+    """RecBuilder that encodes images on a process pool.
+
+    Each add() call, i.e. one identity, becomes one encoding task. A single
+    writer in the calling process writes the records strictly in key order
+    as the tasks complete, so the rec, the identity records and header0 are
+    laid out exactly as RecBuilder writes them. At most `max_pending`
+    images are in flight.
+    """
+    def __init__(self, path, image_size=(112, 112), workers=8,
+                 max_pending=4096, append=False):
+        RecBuilder.__init__(self, path, image_size, append)
+        self.pool = multiprocessing.Pool(workers)
+        self.pending = collections.deque()
+        self.num_pending = 0
+        self.max_pending = max_pending
+
+    def write_records(self, headers, imgs):
+        task = ([tuple(header) for header in headers], imgs)
+        result = self.pool.apply_async(_pack_records, (task, ))
+        self.pending.append((headers, result))
+        self.num_pending += len(headers)
+        self.flush()
+
+    def flush(self, wait=False):
+        """Writes the finished tasks at the head of the queue, waiting for
+        them while too many images are in flight or when `wait` is set."""
+        while self.pending:
+            headers, result = self.pending[0]
+            if not (wait or self.num_pending > self.max_pending or
+                    result.ready()):
+                break
+            for header, s in zip(headers, result.get()):
+                self.writer.write_idx(header.id, s)
+            self.pending.popleft()
+            self.num_pending -= len(headers)
+
+    def close(self):
+        self.flush(wait=True)
+        self.pool.close()
+        self.pool.join()
+        RecBuilder.close(self)
@@ -0,0 +1,96 @@
+"""Cached identity index for identity-grouped rec files.
+
+Building `id2range` needs one random read per identity record. The result
+is saved next to the rec as `<name>.f<images_filter>.index.npz` and reused
+as long as the rec file keeps the same size and mtime.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import logging
+import numpy as np
+from mxnet import recordio
+
+
+def index_path(path_imgrec, images_filter=0):
+    return '%s.f%d.index.npz' % (os.path.splitext(path_imgrec)[0],
+                                 images_filter)
+
+
+def _rec_stat(path_imgrec):
+    st = os.stat(path_imgrec)
+    return np.array([st.st_size, int(st.st_mtime * 1e6)], dtype=np.int64)
+
+
+def build_index(imgrec, images_filter=0):
+    """Scans header0 and the identity records of an open
+    MXIndexedRecordIO.
+
+    Returns (header0, identities, imgidx): header0 is the (begin, end) key
+    range of the identity records, identities a (K,3) int64 array of
+    (identity key, first image key, end image key) for the identities
+    with at least `images_filter` images, and imgidx their image keys.
+    """
+    s = imgrec.read_idx(0)
+    header, _ = recordio.unpack(s)
+    assert header.flag > 0
+    header0 = (int(header.label[0]), int(header.label[1]))
+    identities = []
+    for identity in range(header0[0], header0[1]):
+        s = imgrec.read_idx(identity)
+        header, _ = recordio.unpack(s)
+        a, b = int(header.label[0]), int(header.label[1])
+        if b - a < images_filter:
+            continue
+        identities.append((identity, a, b))
+    identities = np.array(identities, dtype=np.int64).reshape((-1, 3))
+    imgidx = np.concatenate([np.arange(a, b, dtype=np.int64)
+                             for _, a, b in identities] +
+                            [np.zeros((0, ), dtype=np.int64)])
+    return header0, identities, imgidx
+
+
+def save_index(path_imgrec, images_filter, header0, identities, imgidx):
+    path = index_path(path_imgrec, images_filter)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            np.savez(f,
+                     rec_stat=_rec_stat(path_imgrec),
+                     header0=np.array(header0, dtype=np.int64),
+                     identities=identities,
+                     imgidx=imgidx)
+        # atomic, so concurrently starting workers never see a partial file
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        logging.warning('cannot save identity index %s: %s', path, e)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def load_index(path_imgrec, images_filter=0):
+    """Returns (header0, identities, imgidx) from the cache, or None when
+    there is no cache or the rec file changed since it was written."""
+    path = index_path(path_imgrec, images_filter)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        if not np.array_equal(f['rec_stat'], _rec_stat(path_imgrec)):
+            logging.info('identity index %s is stale', path)
+            return None
+        header0 = tuple(int(x) for x in f['header0'])
+        return header0, f['identities'], f['imgidx']
+
+
+def get_index(imgrec, path_imgrec, images_filter=0):
+    """Loads the cached identity index, building and saving it if needed."""
+    index = load_index(path_imgrec, images_filter)
+    if index is None:
+        index = build_index(imgrec, images_filter)
+        save_index(path_imgrec, images_filter, *index)
+    else:
+        logging.info('loaded identity index %s',
+                     index_path(path_imgrec, images_filter))
+    return index
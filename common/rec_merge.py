@@ -0,0 +1,100 @@
+"""Merges identity-grouped rec datasets into one, without decoding images.
+
+Identities are streamed from every source in turn (e.g. emore, then
+Webface-OCC, then a masked set) and relabeled to one contiguous range in
+that order. Image payloads are copied byte for byte; only the record
+headers are rewritten. Occlusion masks are taken from a source's
+train.mask sidecar, or from its record headers, and written to the bit-
+packed sidecar of the output. The output gets a fresh identity table,
+header0 and property, plus `label_map.txt` with one
+`<source no> <old label> <new label>` line per identity.
+
+Usage: python rec_merge.py --include /path/to/emore,/path/to/webface_occ --output /path/to/merged
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import numbers
+import argparse
+import numpy as np
+import mxnet as mx
+import mask_pack
+from rec_builder import RecBuilder
+from rec_index import build_index
+from mmap_recordio import MmapIndexedRecordIO
+
+
+def read_identity(imgrec, maskrec, a, b, image_size):
+    """Returns (label, payloads, masks) of the images with keys [a, b);
+    masks is None when none of them is occluded."""
+    mask_len = image_size[0] * image_size[1]
+    label = None
+    imgs = []
+    masks = [None] * (b - a)
+    if maskrec is not None:
+        rows = maskrec.read_rows(np.arange(a, b))
+        for i in np.where(rows.any(axis=1))[0]:
+            masks[i] = mask_pack.unpack_masks(rows[i:i + 1], image_size)[0, 0]
+    for i, idx in enumerate(range(a, b)):
+        header, img = mx.recordio.unpack(imgrec.read_idx(idx))
+        _label = header.label
+        if not isinstance(_label, numbers.Number):
+            if maskrec is None and len(_label) >= 2 + mask_len:
+                mask = np.asarray(_label[2:2 + mask_len])
+                if mask.any():
+                    masks[i] = mask.reshape(image_size)
+            _label = _label[0]
+        if label is None:
+            label = int(_label)
+        imgs.append(bytes(img))
+    if all(mask is None for mask in masks):
+        masks = None
+    return label, imgs, masks
+
+
+def main(args):
+    image_size = [int(x) for x in args.image_size.split(',')]
+    builder = RecBuilder(args.output, image_size=image_size)
+    new_label = 0
+    with open(os.path.join(args.output, 'label_map.txt'), 'w') as label_map:
+        for ds_id, ds in enumerate(args.include.split(',')):
+            path_imgrec = os.path.join(ds, 'train.rec')
+            imgrec = MmapIndexedRecordIO(os.path.join(ds, 'train.idx'),
+                                         path_imgrec)
+            header, _ = mx.recordio.unpack(imgrec.read_idx(0))
+            if header.flag == 0:
+                raise ValueError('%s has no identity table' % path_imgrec)
+            maskrec = None
+            if os.path.exists(mask_pack.mask_path(path_imgrec)):
+                maskrec = mask_pack.MaskReader(
+                    mask_pack.mask_path(path_imgrec))
+                assert list(maskrec.image_size) == image_size, \
+                    'mask size %s of %s' % (maskrec.image_size, ds)
+            _, identities, _ = build_index(imgrec, args.images_filter)
+            print('dataset %d: %d identities from %s, labels %d-%d' %
+                  (ds_id, len(identities), ds, new_label,
+                   new_label + len(identities) - 1))
+            for _, a, b in identities:
+                if b == a:
+                    continue
+                label, imgs, masks = read_identity(imgrec, maskrec, int(a),
+                                                   int(b), image_size)
+                builder.add(new_label, imgs, masks)
+                label_map.write('%d %d %d\n' % (ds_id, label, new_label))
+                new_label += 1
+                if new_label % 10000 == 0:
+                    print('merged identities', new_label)
+            imgrec.close()
+    builder.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='merge rec datasets with contiguous labels')
+    # general
+    parser.add_argument('--include', default='', type=str, help='comma separated dataset dirs with train.rec')
+    parser.add_argument('--output', default='', type=str, help='')
+    parser.add_argument('--image-size', default='112,112', type=str, help='')
+    parser.add_argument('--images-filter', default=0, type=int, help='drop identities with fewer images')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,54 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import shutil
+import argparse
+import mxnet as mx
+import numpy as np
+from mask_pack import MaskWriter
+
+
+def main(args):
+    path_imgrec = os.path.join(args.input, 'train.rec')
+    path_imgidx = os.path.join(args.input, 'train.idx')
+    imgrec = mx.recordio.MXIndexedRecordIO(path_imgidx, path_imgrec, 'r')  # pylint: disable=redefined-variable-type
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    writer = mx.recordio.MXIndexedRecordIO(
+        os.path.join(args.output, 'train.idx'),
+        os.path.join(args.output, 'train.rec'), 'w')
+    image_size = [int(x) for x in args.image_size.split(',')]
+    mask_writer = MaskWriter(os.path.join(args.output, 'train.mask'),
+                             image_size)
+    mask_len = image_size[0] * image_size[1]
+    # header0 and the identity records are copied as they are, image
+    # records keep their key so that the sidecar row lines up with .idx
+    for pp, idx in enumerate(sorted(imgrec.keys)):
+        s = imgrec.read_idx(idx)
+        header, img = mx.recordio.unpack(s)
+        if header.flag >= 2 + mask_len:
+            label = np.asarray(header.label, dtype=np.float32)
+            mask_writer.write(idx, label[2:2 + mask_len])
+            header = mx.recordio.IRHeader(2, label[:2], header.id,
+                                          header.id2)
+            s = mx.recordio.pack(header, img)
+        writer.write_idx(idx, s)
+        if pp % 10000 == 0:
+            print('processing', pp)
+    writer.close()
+    mask_writer.close()
+    prop = os.path.join(args.input, 'property')
+    if os.path.exists(prop):
+        shutil.copy(prop, os.path.join(args.output, 'property'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='move occlusion masks from record headers to a bit-packed sidecar')
+    # general
+    parser.add_argument('--input', default='', type=str, help='dataset dir with train.rec')
+    parser.add_argument('--output', default='', type=str, help='')
+    parser.add_argument('--image-size', default='112,112', type=str, help='')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,182 @@
+"""Re-encodes the images of a rec file and reports the speed/size tradeoff.
+
+Every target format gets its own copy of the dataset under --output,
+e.g. `jpg90/`, `png3/`, `webp95/` or `raw/`. Image payloads are re-encoded
+on a process pool from the decoded source pixels; record headers, keys
+and all non-image records are kept, so train.mask and the other key-
+indexed sidecars are copied unchanged. The report lists, for the source
+and every target, the rec size, the mean bytes per image, the decode
+throughput in images/sec on one core and the PSNR against the source
+pixels. See image_codec for the formats.
+
+Usage: python rec_reencode.py --input /path/to/ds --output /path/to/out --formats jpg:90,png,webp:95,raw --workers 8
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import time
+import shutil
+import argparse
+import multiprocessing
+import numpy as np
+import mxnet as mx
+import image_codec
+from rec_index import build_index
+from mmap_recordio import MmapIndexedRecordIO, IndexedRecordIOWriter
+
+DEFAULT_QUALITY = {'jpg': 95, 'png': 3, 'webp': 95, 'raw': 0}
+# key-indexed files that do not depend on the payload
+SIDECARS = ('train.mask', 'train.occ.npy', 'property')
+
+
+def parse_formats(formats):
+    """'jpg:90,png,raw' -> [('jpg', 90), ('png', 3), ('raw', 0)]"""
+    targets = []
+    for item in formats.split(','):
+        fmt, _, quality = item.partition(':')
+        if fmt not in image_codec.FORMATS:
+            raise ValueError('unknown image format %s' % fmt)
+        targets.append((fmt, int(quality) if quality else DEFAULT_QUALITY[fmt]))
+    return targets
+
+
+def target_name(fmt, quality):
+    return fmt if fmt == 'raw' else '%s%d' % (fmt, quality)
+
+
+def open_rec(path):
+    return MmapIndexedRecordIO(os.path.join(path, 'train.idx'),
+                               os.path.join(path, 'train.rec'))
+
+
+# opened once per worker process
+_imgrec = None
+
+
+def _reencode(task):
+    global _imgrec
+    path, keys, fmt, quality = task
+    if _imgrec is None:
+        _imgrec = open_rec(path)
+    records = []
+    for key in keys:
+        s = _imgrec.read_idx(key)
+        _, payload = mx.recordio.unpack(s)
+        img = image_codec.decode(payload)
+        if img is None:
+            # kept as is, the iterator skips it just like in the source
+            records.append((key, bytes(s)))
+            continue
+        header = bytes(s[:len(s) - len(payload)])
+        records.append((key, header + image_codec.encode(img, fmt, quality)))
+    return records
+
+
+def measure(path, keys, reference=None):
+    """Returns (images/sec, decoded images, PSNR against `reference`)."""
+    imgrec = open_rec(path)
+    payloads = [mx.recordio.unpack(imgrec.read_idx(int(key)))[1]
+                for key in keys]
+    tic = time.time()
+    imgs = [image_codec.decode(s) for s in payloads]
+    speed = len(keys) / max(time.time() - tic, 1e-9)
+    psnr = float('nan')
+    if reference is not None:
+        mse = np.mean([
+            np.mean((a.astype(np.float32) - b.astype(np.float32))**2)
+            for a, b in zip(imgs, reference)
+        ])
+        psnr = 10 * np.log10(255.0**2 / mse) if mse > 0 else float('inf')
+    imgs = [np.array(img) for img in imgs]
+    del payloads
+    imgrec.close()
+    return speed, imgs, psnr
+
+
+def image_bytes(path, keys):
+    imgrec = open_rec(path)
+    total = sum(len(mx.recordio.unpack(imgrec.read_idx(int(key)))[1])
+                for key in keys)
+    imgrec.close()
+    return total
+
+
+def main(args):
+    targets = parse_formats(args.formats)
+    imgrec = open_rec(args.input)
+    header, _ = mx.recordio.unpack(imgrec.read_idx(0))
+    if header.flag > 0:
+        _, _, image_keys = build_index(imgrec)
+    else:
+        image_keys = np.array(sorted(imgrec.keys), dtype=np.int64)
+    image_set = set(image_keys.tolist())
+    # identity records and header0, copied after the images as RecBuilder
+    # lays them out
+    other_keys = [key for key in imgrec.keys if key not in image_set]
+    imgrec.close()
+    tasks = [image_keys[a:a + args.chunk].tolist()
+             for a in range(0, len(image_keys), args.chunk)]
+    pool = multiprocessing.Pool(args.workers)
+    for fmt, quality in targets:
+        output = os.path.join(args.output, target_name(fmt, quality))
+        if not os.path.exists(output):
+            os.makedirs(output)
+        print('encoding %d images to %s' % (len(image_keys), output))
+        writer = IndexedRecordIOWriter(os.path.join(output, 'train.idx'),
+                                       os.path.join(output, 'train.rec'))
+        done = 0
+        for records in pool.imap(_reencode,
+                                 [(args.input, keys, fmt, quality)
+                                  for keys in tasks]):
+            for key, s in records:
+                writer.write_idx(key, s)
+            done += len(records)
+            if done % (args.chunk * 50) < args.chunk:
+                print('encoded', done, len(image_keys))
+        imgrec = open_rec(args.input)
+        for key in other_keys:
+            writer.write_idx(key, imgrec.read_idx(key))
+        imgrec.close()
+        writer.close()
+        for name in SIDECARS:
+            if os.path.exists(os.path.join(args.input, name)):
+                shutil.copy(os.path.join(args.input, name),
+                            os.path.join(output, name))
+    pool.close()
+    pool.join()
+
+    bench_keys = image_keys
+    if len(bench_keys) > args.bench:
+        bench_keys = np.random.RandomState(0).choice(bench_keys, args.bench,
+                                                     replace=False)
+    rows = [('source', args.input)] + [
+        (target_name(fmt, quality),
+         os.path.join(args.output, target_name(fmt, quality)))
+        for fmt, quality in targets
+    ]
+    print('decode speed over %d images on one core' % len(bench_keys))
+    print('%-10s %12s %10s %12s %8s' % ('format', 'rec MB', 'KB/image',
+                                        'images/sec', 'PSNR'))
+    reference = None
+    for name, path in rows:
+        speed, imgs, psnr = measure(path, bench_keys, reference)
+        if reference is None:
+            reference = imgs
+        size = os.path.getsize(os.path.join(path, 'train.rec'))
+        per_image = image_bytes(path, bench_keys) / float(len(bench_keys))
+        print('%-10s %12.1f %10.2f %12.1f %8.2f' %
+              (name, size / 1e6, per_image / 1e3, speed, psnr))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='re-encode the images of a rec file')
+    # general
+    parser.add_argument('--input', default='', type=str, help='dataset dir with train.rec')
+    parser.add_argument('--output', default='', type=str, help='one subdir per format is written here')
+    parser.add_argument('--formats', default='jpg:95,jpg:75,png,webp:95,raw', type=str, help='format[:quality] list')
+    parser.add_argument('--workers', default=8, type=int, help='encoding processes')
+    parser.add_argument('--chunk', default=256, type=int, help='images per task')
+    parser.add_argument('--bench', default=2000, type=int, help='images decoded per format for the report')
+    args = parser.parse_args()
+    main(args)